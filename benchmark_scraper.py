@@ -0,0 +1,35 @@
+from pathlib import Path
+
+from src.scraper.benchmark import benchmark_crawl, benchmark_extraction, load_fixtures
+from src.scraper.forum import CACHE_DIR, Website
+from src.scraper.mock_forum import MockForumConfig
+from src.scraper.parsers import POST_PARSERS, check_parity
+from src.utils import save_results
+
+# Measures the scraper hot paths. Run it before and after every performance change and
+# compare the lines appended to RESULTS.
+FIXTURES = 200  # thread pages for the microbenchmarks, recorded ones from CACHE_DIR if any
+CRAWLS = [
+    MockForumConfig(threads=200, latency=0.05),
+    MockForumConfig(threads=200, latency=0.2, jitter=0.1),
+    MockForumConfig(threads=200, latency=0.05, error_rate=0.05),
+]
+RESULTS = Path("data/benchmarks.jsonl")
+
+if __name__ == "__main__":
+    pages = load_fixtures(CACHE_DIR, FIXTURES)
+    # Every backend must extract exactly the posts bs4 does, on the recorded pages and
+    # on generated ones, which include scripts, styles and every kind of embed
+    for name in POST_PARSERS:
+        posts = check_parity(pages + load_fixtures(None, FIXTURES), name)
+        print(f"{name}: {posts} posts identical to bs4")
+    website = Website("http://localhost")
+    results = benchmark_extraction(website, pages)
+    website.close()
+    for result in results:
+        print(result)
+    for config in CRAWLS:
+        result = benchmark_crawl(config)
+        print(f"{result}  ({config.error_rate:.0%} errors)")
+        results.append(result)
+    save_results(results, RESULTS)
@@ -0,0 +1,21 @@
+from pathlib import Path
+
+import pandas as pd
+
+from src.analysis.benchmark import benchmark_backends, sample_posts
+from src.utils import save_results
+
+# Compares the toxicity scoring backends with the reference model on CPU: throughput and
+# deviation of the scores. Run it before switching process_data.py to another backend.
+POSTS = Path("data/import/posts.csv")
+SAMPLE_SIZE = 2000
+RESULTS = Path("data/benchmarks.jsonl")
+
+if __name__ == "__main__":
+    print("Loading data...")
+    texts = sample_posts(pd.read_csv(POSTS), SAMPLE_SIZE)
+    print(f"Scoring {len(texts)} posts with every backend...")
+    results = benchmark_backends(texts)
+    for result in results:
+        print(result)
+    save_results(results, RESULTS)
@@ -1,13 +1,20 @@
+from pathlib import Path
+
 import pandas as pd
 import statsmodels.api as sm
 
-from src.analysis.feminism import (
-    compute_feminism_scores,
-    compute_incel_scores,
-    compute_sexual_scores,
-)
+from src.analysis.feminism import score_parquet, score_posts
+
+# Set to a Parquet file or directory, e.g. a posts dump, to score posts that do not fit
+# in memory batch by batch
+PARQUET_SOURCE: Path | None = None
+PARQUET_DESTINATION = Path("data/import/posts_scored")
 
 if __name__ == "__main__":
+    if PARQUET_SOURCE is not None:
+        print(f"Computing feminism, sexual and incel scores of {PARQUET_SOURCE}...")
+        score_parquet(PARQUET_SOURCE, PARQUET_DESTINATION)
+        raise SystemExit
     print("Loading data...")
     posts = pd.read_csv("data/import/posts.csv")
 
@@ -17,12 +24,8 @@ if __name__ == "__main__":
 
     # plot_prev = sm.qqplot(posts["feminism_score"].sample(100_000), line="s")
     # plot_prev.show()
-    print("Computing feminism scores...")
-    posts = compute_feminism_scores(posts)
-    print("Computing sexual scores...")
-    posts = compute_sexual_scores(posts)
-    print("Computing incel scores...")
-    posts = compute_incel_scores(posts)
+    print("Computing feminism, sexual and incel scores...")
+    posts = score_posts(posts)
     # plot = sm.qqplot(posts["feminism_score"].sample(100_000), line="s")
     # plot.show()
 
@@ -0,0 +1,16 @@
+from src.scraper.forum import CACHE_DIR, Website
+
+# Rebuild the posts of already crawled forums from the page cache, e.g. after changing
+# the extraction rules. Needs a crawl run with the page cache enabled in scrape.py.
+FORUMS = [
+    ("must-read-content", 23),
+    # ("the-lounge", 4),
+    # ("inceldom-discussion", 2),
+]
+
+if __name__ == "__main__":
+    website = Website("https://incels.is", cache_dir=CACHE_DIR)
+    for label, id in FORUMS:
+        posts = website.reparse(label, id)
+        print(posts)
+    website.close()
@@ -1,15 +1,22 @@
 import pathlib
 
-from src.scraper.forum import Website
+from src.scraper.forum import CACHE_DIR, Website
 
 FORUMS = [
     ("must-read-content", 23),
     # ("the-lounge", 4),
     # ("inceldom-discussion", 2),
 ]
+INCREMENTAL = False  # only fetch threads that are new or changed since the last crawl
+CACHE = True  # keep the raw thread pages, so reparse.py can rebuild the posts offline
+METRICS_PORT = None  # e.g. 9100 to serve Prometheus metrics at localhost:9100/metrics
 
 if __name__ == "__main__":
     pathlib.Path("/data/").mkdir(parents=True, exist_ok=True)
-    website = Website("https://incels.is")
-    for forum in FORUMS:
-        website.load_and_save_forum(*forum)
+    website = Website(
+        "https://incels.is",
+        cache_dir=CACHE_DIR if CACHE else None,
+        metrics_port=METRICS_PORT,
+    )
+    website.load_and_save_forums(FORUMS, incremental=INCREMENTAL)
+    website.close()
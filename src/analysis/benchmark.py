@@ -0,0 +1,96 @@
+"""
+Benchmarks of the toxicity scoring backends.
+
+Every backend scores the same sample of posts on CPU. Its throughput is compared with
+the full precision reference model, and so are its scores (see `score_deviation`). None
+of the backends is fitted to posts, so any sample is held out. Run with
+`python benchmark_toxicity.py`.
+"""
+
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from src.analysis.toxic import BACKENDS, CPU_THREADS, load_engine, score_deviation
+
+MAX_DEVIATION = 0.02  # mean absolute deviation of a score tolerated from the reference
+WARM_UP = 32  # posts scored before timing, to leave out one-off allocations
+
+
+@dataclass(slots=True)
+class BackendResult:
+    """
+    Attributes:
+        backend (str): The backend measured.
+        posts (int): The number of posts scored per run.
+        seconds (float): The best wall time of the runs.
+        speedup (float): How many times faster than the reference model.
+        deviation (dict[str, float]): The deviation of the scores from the reference.
+    """
+
+    backend: str
+    posts: int
+    seconds: float
+    speedup: float = 1.0
+    deviation: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def per_second(self) -> float:
+        return self.posts / self.seconds if self.seconds else 0.0
+
+    @property
+    def acceptable(self) -> bool:
+        """Whether no score deviates more than MAX_DEVIATION on average."""
+        means = [v for k, v in self.deviation.items() if k.endswith("_mean")]
+        return max(means, default=0.0) <= MAX_DEVIATION
+
+    def __str__(self) -> str:
+        line = (
+            f"{self.backend:<16} {self.per_second:>8.1f} posts/s  {self.seconds:>8.2f} s"
+            f"  {self.speedup:>5.2f}x"
+        )
+        for key, value in self.deviation.items():
+            if key.endswith("_mean"):
+                line += f"  {key.removesuffix('_mean')} ±{value:.4f}"
+        if self.deviation:
+            line += "" if self.acceptable else "  (exceeds MAX_DEVIATION)"
+        return line
+
+
+def sample_posts(posts: pd.DataFrame, size: int, seed: int = 0) -> list[str]:
+    """Returns the content of `size` posts drawn at random, reproducibly."""
+    posts = posts.dropna(subset=["content"])
+    return posts["content"].sample(min(size, len(posts)), random_state=seed).tolist()
+
+
+def benchmark_backends(
+    texts: list[str],
+    backends: tuple[str, ...] = BACKENDS,
+    threads: int = CPU_THREADS,
+    repeat: int = 1,
+) -> list[BackendResult]:
+    """
+    Scores the posts with every backend on CPU and compares throughput and scores with
+    the reference "torch" backend, which is always measured first.
+    """
+    results: list[BackendResult] = []
+    reference: np.ndarray | None = None
+    for backend in ("torch", *(b for b in backends if b != "torch")):
+        engine = load_engine(backend, "cpu", threads)
+        engine.predict(texts[:WARM_UP])
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            scores = engine.predict(texts)
+            best = min(best, time.perf_counter() - start)
+        if reference is None:
+            reference = scores
+            results.append(BackendResult(backend, len(texts), best))
+        else:
+            speedup = results[0].seconds / best
+            deviation = score_deviation(scores, reference)
+            results.append(BackendResult(backend, len(texts), best, speedup, deviation))
+    return results
+
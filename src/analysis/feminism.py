@@ -1,5 +1,19 @@
+import math
+import re
+import shutil
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from scipy import sparse
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
 
 pd.options.mode.copy_on_write = True
 
@@ -113,39 +127,320 @@ incel_keywords = [
 ]
 
 
-def compute_feminism_scores(posts: pd.DataFrame) -> pd.DataFrame:
+LEXICONS = {
+    "feminism": feminism_keywords,
+    "sexual": sexual_keywords,
+    "incel": incel_keywords,
+}
+
+BATCH_SIZE = 100_000  # posts scored at a time by score_parquet
+
+# The tokens of CountVectorizer: lowercase runs of at least two word characters
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+class LexiconScorer:
     """
-    Compute feminism scores for a given set of posts.
+    Counts the keywords of several named lexicons in one pass over the posts.
+
+    Every post is tokenized once like CountVectorizer(stop_words="english") does, and
+    the tokens are matched against a trie of all keywords of all lexicons, so multi-word
+    keywords such as "gender pay gap" match as phrases. A keyword counts once for every
+    lexicon it belongs to, and overlapping keywords are all counted, e.g. "women's
+    rights" counts both "women" and "women's rights".
+
+    The counts stay sparse throughout: a texts × terms CSR matrix is built while
+    scanning, and lexicon totals are its product with the terms × lexicons membership
+    matrix, so memory does not grow with texts × terms.
+
+    Attributes:
+        lexicons (dict[str, list[str]]): The keywords of every lexicon by name.
+        terms (list[str]): The distinct keywords as token sequences joined by spaces.
+    """
+
+    def __init__(
+        self,
+        lexicons: dict[str, list[str]],
+        stop_words: frozenset[str] = ENGLISH_STOP_WORDS,
+    ) -> None:
+        self.lexicons = lexicons
+        self.stop_words = stop_words
+        self.terms: list[str] = []
+        self._lexicons_of: list[list[int]] = []  # lexicon ids of every term id
+        self._trie: dict = {}  # token -> child node; the None key holds a term id
+        for lexicon, keywords in enumerate(lexicons.values()):
+            for keyword in keywords:
+                tokens = self.tokenize(keyword)
+                if not tokens:
+                    continue
+                node = self._trie
+                for token in tokens:
+                    node = node.setdefault(token, {})
+                if None not in node:
+                    node[None] = len(self.terms)
+                    self.terms.append(" ".join(tokens))
+                    self._lexicons_of.append([])
+                if lexicon not in self._lexicons_of[node[None]]:
+                    self._lexicons_of[node[None]].append(lexicon)
+
+    def tokenize(self, text: str) -> list[str]:
+        """Returns the tokens of a text that keywords are matched against."""
+        stop_words = self.stop_words
+        return [
+            token
+            for token in TOKEN_PATTERN.findall(text.lower())
+            if token not in stop_words
+        ]
+
+    @property
+    def membership(self) -> sparse.csr_matrix:
+        """The terms × lexicons matrix with a 1 where a term belongs to a lexicon."""
+        rows = [term for term, lexicons in enumerate(self._lexicons_of) for _ in lexicons]
+        columns = [lexicon for lexicons in self._lexicons_of for lexicon in lexicons]
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, columns)),
+            shape=(len(self.terms), len(self.lexicons)),
+        )
+
+    def term_counts(self, texts: Iterable[str]) -> tuple[sparse.csr_matrix, np.ndarray]:
+        """
+        Counts every keyword in every text, building the sparse matrix directly so
+        memory grows with the keywords found, not with texts × terms.
+
+        Parameters:
+        texts (Iterable[str]): The texts to count keywords in.
+
+        Returns:
+        tuple[sparse.csr_matrix, np.ndarray]: The texts × terms matrix of keyword
+            counts, and the word count of every text, i.e. 3 plus the number of
+            whitespace separated words.
+        """
+        trie = self._trie
+        indptr = array("q", [0])
+        indices = array("i")
+        data = array("i")
+        word_counts = array("q")
+        for text in texts:
+            found: dict[int, int] = {}
+            tokens = self.tokenize(text)
+            n = len(tokens)
+            for i in range(n):
+                node = trie.get(tokens[i])
+                j = i + 1
+                while node is not None:
+                    term = node.get(None)
+                    if term is not None:
+                        found[term] = found.get(term, 0) + 1
+                    if j == n:
+                        break
+                    node = node.get(tokens[j])
+                    j += 1
+            for term in sorted(found):
+                indices.append(term)
+                data.append(found[term])
+            indptr.append(len(indices))
+            word_counts.append(3 + len(text.split()))
+        matrix = sparse.csr_matrix(
+            (
+                np.frombuffer(data, dtype=np.int32),
+                np.frombuffer(indices, dtype=np.int32),
+                np.frombuffer(indptr, dtype=np.int64),
+            ),
+            shape=(len(word_counts), len(self.terms)),
+        )
+        return matrix, np.frombuffer(word_counts, dtype=np.int64)
+
+    def count(self, texts: Iterable[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Counts the keywords of every lexicon in every text.
+
+        Parameters:
+        texts (Iterable[str]): The texts to count keywords in.
+
+        Returns:
+        tuple[np.ndarray, np.ndarray]: The keyword counts, one row per text and one
+            column per lexicon, and the word count of every text.
+        """
+        matrix, word_counts = self.term_counts(texts)
+        return self.lexicon_counts(matrix), word_counts
+
+    def lexicon_counts(self, matrix: sparse.csr_matrix) -> np.ndarray:
+        """
+        Sums the term counts of every lexicon with a sparse product, returning one
+        column per lexicon.
+        """
+        return (matrix @ self.membership).toarray()
+
+    def keyword_totals(self, matrix: sparse.csr_matrix) -> pd.Series:
+        """Returns how often every term occurs across all texts of a term count matrix."""
+        return pd.Series(
+            np.asarray(matrix.sum(axis=0)).ravel(), index=self.terms, name="count"
+        )
+
+    def breakdown(self, matrix: sparse.csr_matrix, index: pd.Index) -> pd.DataFrame:
+        """
+        Returns the term counts as sparse columns named "<term>_count", with spaces in
+        terms replaced by underscores.
+        """
+        columns = [term.replace(" ", "_") + "_count" for term in self.terms]
+        return pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+
+    def score(self, posts: pd.DataFrame, breakdown: bool = False) -> pd.DataFrame:
+        """
+        Computes the score of every lexicon for a given set of posts in one pass.
+
+        The score of a lexicon is the number of its keywords in the post relative to the
+        word count of the post, min-max normalized over all posts.
+
+        Parameters:
+        posts (pd.DataFrame): A DataFrame containing the posts to score.
+        breakdown (bool): Also add the count of every term as a sparse column.
+
+        Returns:
+        pd.DataFrame: The posts without duplicate indices, with a "word_count" column
+            and a "<lexicon>_score" column per lexicon.
+        """
+        # drop rows with duplicate indices
+        posts = posts[~posts.index.duplicated(keep="first")]
+        matrix, word_counts = self.term_counts(posts["content"])
+        counts = self.lexicon_counts(matrix)
+        posts["word_count"] = word_counts
+        for lexicon, name in enumerate(self.lexicons):
+            posts[f"{name}_score"] = _normalize(counts[:, lexicon] / word_counts)
+        if breakdown:
+            posts = pd.concat([posts, self.breakdown(matrix, posts.index)], axis=1)
+        return posts
+
+
+@dataclass
+class ScoreRange:
+    """
+    The minimum and maximum of raw scores seen so far. Ranges of separate partitions
+    merge into the range of all of them, so scores can be normalized globally without
+    holding them all in memory.
+    """
+
+    min: float = math.inf
+    max: float = -math.inf
+
+    def update(self, scores: np.ndarray) -> None:
+        """Widens the range to include the scores."""
+        if len(scores):
+            self.min = min(self.min, float(np.min(scores)))
+            self.max = max(self.max, float(np.max(scores)))
+
+    def merge(self, other: "ScoreRange") -> "ScoreRange":
+        """Returns the range covering both ranges."""
+        return ScoreRange(min(self.min, other.min), max(self.max, other.max))
+
+    def normalize(self, scores: np.ndarray) -> np.ndarray:
+        """
+        Min-max normalizes the scores to the range. All NaN if the range is a single
+        value, like the normalization of pandas gives.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (scores - self.min) / (self.max - self.min)
+
+
+def _normalize(scores: np.ndarray) -> np.ndarray:
+    score_range = ScoreRange()
+    score_range.update(scores)
+    return score_range.normalize(scores)
+
+
+def score_posts(
+    posts: pd.DataFrame,
+    lexicons: dict[str, list[str]] = LEXICONS,
+    breakdown: bool = False,
+) -> pd.DataFrame:
+    """
+    Compute the scores of several lexicons, by default feminism, sexual and incel, for
+    a given set of posts, tokenizing every post once. See `LexiconScorer`.
 
     Parameters:
-    posts (pd.DataFrame): A DataFrame containing the posts to compute feminism scores for.
+    posts (pd.DataFrame): A DataFrame containing the posts to compute scores for.
+    lexicons (dict[str, list[str]]): The keywords of every lexicon by name.
+    breakdown (bool): Also add the count of every keyword as a sparse column.
 
     Returns:
-    pd.DataFrame: A DataFrame with the computed feminism scores.
+    pd.DataFrame: A DataFrame with a "<lexicon>_score" column per lexicon.
+    """
+    return LexiconScorer(lexicons).score(posts, breakdown)
+
+
+def score_parquet(
+    source: str | Path,
+    destination: Path,
+    lexicons: dict[str, list[str]] = LEXICONS,
+    batch_size: int = BATCH_SIZE,
+) -> dict[str, ScoreRange]:
+    """
+    Compute the scores of several lexicons for posts stored in Parquet, out of core.
+
+    The posts are streamed in batches of at most `batch_size` rows. The first pass
+    tokenizes every batch once, writes its raw scores next to the posts and merges the
+    range of the raw scores of every lexicon. The second pass reads the raw scores back
+    and normalizes them with the global ranges, so the scores equal those of
+    `score_posts` while only one batch is held in memory at a time. Posts without
+    content are skipped. Unlike `score_posts`, duplicate posts are not dropped.
+
+    Parameters:
+    source (str | Path): A Parquet file or a directory of them, e.g. a posts dump.
+    destination (Path): The directory the scored posts are written to as Parquet
+        files, replacing earlier ones.
+    lexicons (dict[str, list[str]]): The keywords of every lexicon by name.
+    batch_size (int): The most posts scored at a time.
+
+    Returns:
+    dict[str, ScoreRange]: The range of the raw scores of every lexicon.
     """
-    # drop rows with duplicate indices
-    posts = posts[~posts.index.duplicated(keep="first")]
-    # TF-IDF Vectorization
-    vectorizer = CountVectorizer(stop_words="english", vocabulary=feminism_keywords)
-    posts_vector = vectorizer.fit_transform(posts["content"])
-    # Create column in posts for "content" word count
-    posts["word_count"] = posts["content"].apply(lambda x: 3 + len(x.split()))
-    # Compute feminism counts for each post as an pd.Series
-    feminism_counts = pd.Series(posts_vector.toarray().sum(axis=1))  # type: ignore
-    # Compute feminism scores for each post. The score is the sum of the counts of the feminism keywords in the post relative to the total number of words in the post.
-    # print(feminism_counts)
-    # print(posts["word_count"])
-    feminism_scores = feminism_counts / posts["word_count"]
-    # normalize the scores
-    feminism_scores = (feminism_scores - feminism_scores.min()) / (
-        feminism_scores.max() - feminism_scores.min()
+    scorer = LexiconScorer(lexicons)
+    ranges = {name: ScoreRange() for name in lexicons}
+    raw = destination / "raw"
+    shutil.rmtree(raw, ignore_errors=True)
+    raw.mkdir(parents=True)
+    for part in destination.glob("part-*.parquet"):
+        part.unlink()
+
+    dataset = ds.dataset(source, format="parquet")
+    batches = dataset.to_batches(
+        filter=pc.field("content").is_valid(), batch_size=batch_size
     )
-    posts["feminism_score"] = feminism_scores
+    parts = 0
+    posts = 0
+    for batch in batches:
+        if not batch.num_rows:
+            continue
+        matrix, word_counts = scorer.term_counts(batch.column("content").to_pylist())
+        counts = scorer.lexicon_counts(matrix)
+        table = pa.Table.from_batches([batch]).append_column(
+            "word_count", pa.array(word_counts)
+        )
+        for lexicon, name in enumerate(lexicons):
+            scores = counts[:, lexicon] / word_counts
+            ranges[name].update(scores)
+            table = table.append_column(f"{name}_score", pa.array(scores))
+        pq.write_table(table, raw / f"part-{parts:06d}.parquet")
+        parts += 1
+        posts += batch.num_rows
+        print(f"Scored {posts} posts", end="\r")
 
-    return posts
+    for part in sorted(raw.glob("part-*.parquet")):
+        table = pq.read_table(part)
+        for name, score_range in ranges.items():
+            column = f"{name}_score"
+            scores = score_range.normalize(table.column(column).to_numpy())
+            table = table.set_column(
+                table.schema.get_field_index(column), column, pa.array(scores)
+            )
+        pq.write_table(table, destination / part.name)
+        part.unlink()
+    raw.rmdir()
+    print(f"\nNormalized the scores of {posts} posts in {parts} batches")
+    return ranges
 
 
-def compute_sexual_scores(posts: pd.DataFrame) -> pd.DataFrame:
+def compute_feminism_scores(posts: pd.DataFrame) -> pd.DataFrame:
     """
     Compute feminism scores for a given set of posts.
 
@@ -155,71 +450,33 @@ def compute_sexual_scores(posts: pd.DataFrame) -> pd.DataFrame:
     Returns:
     pd.DataFrame: A DataFrame with the computed feminism scores.
     """
-    # drop rows with duplicate indices
-    posts = posts[~posts.index.duplicated(keep="first")]
-    # TF-IDF Vectorization
-    vectorizer = CountVectorizer(stop_words="english", vocabulary=sexual_keywords)
-    posts_vector = vectorizer.fit_transform(posts["content"])
-    # Create column in posts for "content" word count
-    posts["word_count"] = posts["content"].apply(lambda x: 3 + len(x.split()))
-    # Compute sexual counts for each post as an pd.Series
-    feminism_counts = pd.Series(posts_vector.toarray().sum(axis=1))  # type: ignore
-    # Compute sexual scores for each post. The score is the sum of the counts of the sexual keywords in the post relative to the total number of words in the post.
-    sexual_scores = feminism_counts / posts["word_count"]
-    # normalize the scores
-    sexual_scores = (sexual_scores - sexual_scores.min()) / (
-        sexual_scores.max() - sexual_scores.min()
-    )
-    # # remove all rows with scores of 1.0
-    # posts["sexual_score"] = sexual_scores
-    # posts = posts[posts["sexual_score"] != 1.0]
-    # # renormalize
-    # sexual_scores = posts["sexual_score"]
-    # sexual_scores = (sexual_scores - sexual_scores.min()) / (
-    #     sexual_scores.max() - sexual_scores.min()
-    # )
-    posts["sexual_score"] = sexual_scores
+    return score_posts(posts, {"feminism": feminism_keywords})
+
+
+def compute_sexual_scores(posts: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compute sexual scores for a given set of posts.
 
-    return posts
+    Parameters:
+    posts (pd.DataFrame): A DataFrame containing the posts to compute sexual scores for.
+
+    Returns:
+    pd.DataFrame: A DataFrame with the computed sexual scores.
+    """
+    return score_posts(posts, {"sexual": sexual_keywords})
 
 
 def compute_incel_scores(posts: pd.DataFrame) -> pd.DataFrame:
     """
-    Compute feminism scores for a given set of posts.
+    Compute incel scores for a given set of posts.
 
     Parameters:
-    posts (pd.DataFrame): A DataFrame containing the posts to compute feminism scores for.
+    posts (pd.DataFrame): A DataFrame containing the posts to compute incel scores for.
 
     Returns:
-    pd.DataFrame: A DataFrame with the computed feminism scores.
+    pd.DataFrame: A DataFrame with the computed incel scores.
     """
-    # drop rows with duplicate indices
-    posts = posts[~posts.index.duplicated(keep="first")]
-    # TF-IDF Vectorization
-    vectorizer = CountVectorizer(stop_words="english", vocabulary=incel_keywords)
-    posts_vector = vectorizer.fit_transform(posts["content"])
-    # Create column in posts for "content" word count
-    if "word_count" not in posts.columns:
-        posts["word_count"] = posts["content"].apply(lambda x: 3 + len(x.split()))
-    # Compute sexual counts for each post as an pd.Series
-    incel_counts = pd.Series(posts_vector.toarray().sum(axis=1))  # type: ignore
-    # Compute sexual scores for each post. The score is the sum of the counts of the sexual keywords in the post relative to the total number of words in the post.
-    incel_scores = incel_counts / posts["word_count"]
-    # normalize the scores
-    incel_scores = (incel_scores - incel_scores.min()) / (
-        incel_scores.max() - incel_scores.min()
-    )
-    # # remove all rows with scores of 1.0
-    # posts["incel_score"] = incel_scores
-    # posts = posts[posts["incel_score"] != 1.0]
-    # # renormalize
-    # incel_scores = posts["incel_score"]
-    # incel_scores = (incel_scores - incel_scores.min()) / (
-    #     incel_scores.max() - incel_scores.min()
-    # )
-    posts["incel_score"] = incel_scores
-
-    return posts
+    return score_posts(posts, {"incel": incel_keywords})
 
 
 if __name__ == "__main__":
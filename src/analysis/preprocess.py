@@ -1,46 +1,89 @@
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import nltk
-import numpy as np
 import pandas as pd
 
+PREPROCESS_WORKERS = os.cpu_count() or 4
+CHUNK_SIZE = 5000  # posts sent to a worker process in one task
+
+# Apostrophes and the punctuation removed from every post
+_PUNCTUATION = str.maketrans("", "", "',.!?")
+_URL = re.compile(r"^https?:\/\/.*[\r\n]*")
+
+# Loaded once per process on first use
+_stop_words: set[str] | None = None
+_lemmatizer: nltk.WordNetLemmatizer | None = None
+_lemmas: dict[str, str] = {}
+
 
 def lemmatize(text):
-    lemmatizer = nltk.WordNetLemmatizer()
-    wstokenizer = nltk.WhitespaceTokenizer()
-    return " ".join([lemmatizer.lemmatize(word) for word in wstokenizer.tokenize(text)])
+    return " ".join(_lemmatize_word(word) for word in text.split())
+
+
+def _lemmatize_word(word: str) -> str:
+    # WordNet lookups are slow and forum vocabulary repeats a lot, so lemmas are cached
+    lemma = _lemmas.get(word)
+    if lemma is None:
+        global _lemmatizer
+        if _lemmatizer is None:
+            _lemmatizer = nltk.WordNetLemmatizer()
+        lemma = _lemmas[word] = _lemmatizer.lemmatize(word)
+    return lemma
+
+
+def preprocess_text(text: str) -> str | None:
+    """
+    Runs every preprocessing step on one post: removes apostrophes and punctuation, a
+    leading url, case and surrounding white space, stop words, and lemmatizes the rest.
+
+    Returns:
+        str | None: The preprocessed post, None if nothing is left of it or it is "nan".
+    """
+    global _stop_words
+    if _stop_words is None:
+        _stop_words = set(nltk.corpus.stopwords.words("english"))
+    text = _URL.sub("", text.translate(_PUNCTUATION)).lower()
+    words = [word for word in text.split() if word not in _stop_words]
+    if not words:
+        return None
+    text = " ".join(_lemmatize_word(word) for word in words)
+    return None if text == "nan" else text
+
 
+def preprocess_texts(texts: list[str]) -> list[str | None]:
+    """Preprocesses a chunk of posts. Runs in the worker processes."""
+    return [preprocess_text(text) for text in texts]
 
-def preprocess(data: pd.DataFrame) -> None:
+
+def preprocess(data: pd.DataFrame, workers: int = PREPROCESS_WORKERS) -> None:
+    """
+    Preprocesses the content of the posts in place, dropping duplicate posts and posts
+    that are empty after preprocessing.
+
+    Every post goes through all steps in one pass (see `preprocess_text`). Chunks of
+    posts are spread over `workers` processes, each with its own lemma cache.
+
+    Args:
+        data (pd.DataFrame): The posts, with "id" and "content" columns.
+        workers (int): The number of worker processes. 1 preprocesses in this process.
+    """
     # Assure that the content column is of type string
     data["content"] = data["content"].astype(str)
     # Remove duplicates
     data.drop_duplicates(subset=["id"], inplace=True)
-    # Remove punctuation
-    data["content"] = data["content"].map(lambda x: x.replace("'", ""))
-    data["content"] = data["content"].map(lambda x: re.sub("[,\\.!?]", "", str(x)))
-    # Remove urls
-    data["content"] = data["content"].map(
-        lambda x: re.sub(r"^https?:\/\/.*[\r\n]*", "", str(x))
-    )
-    # Convert the titles to lowercase and strip leading/trailing white space
-    data["content"] = data["content"].map(lambda x: x.lower().strip())
-    # Remove stop words
-    stop_words = set(nltk.corpus.stopwords.words("english"))
-    data["content"] = data["content"].map(
-        lambda x: " ".join([word for word in x.split() if word not in stop_words])
-    )
-    # Replace empty string in content with NaN
-    data["content"] = data["content"].replace("", np.nan)
-    # Drop rows with NaN in content
-    data.dropna(
-        subset=["content"],
-        inplace=True,
-    )
-    # Lemmatize
-    data["content"] = data["content"].map(lemmatize)
-    # Replace string "nan" with NaN
-    data["content"] = data["content"].replace("nan", np.nan)
+    texts = data["content"].tolist()
+    if workers > 1 and len(texts) > CHUNK_SIZE:
+        chunks = [texts[i : i + CHUNK_SIZE] for i in range(0, len(texts), CHUNK_SIZE)]
+        results: list[str | None] = []
+        with ProcessPoolExecutor(min(workers, len(chunks))) as executor:
+            for chunk in executor.map(preprocess_texts, chunks):
+                results += chunk
+    else:
+        results = preprocess_texts(texts)
+    # Drop the posts with nothing left
+    data["content"] = results
     data.dropna(
         subset=["content"],
         inplace=True,
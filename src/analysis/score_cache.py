@@ -0,0 +1,92 @@
+import hashlib
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+
+LOOKUP_CHUNK = 500  # hashes per query, below the SQLite limit of bound parameters
+
+
+def content_hash(text: str) -> bytes:
+    """Returns the 128 bit BLAKE2 hash of a post, the key of its scores."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class ScoreCache:
+    """
+    On-disk cache of the scores of posts keyed by a hash of their content and by the
+    model that computed them, so that a post is never scored twice by the same model.
+
+    The scores of a model are stored as one row of REAL columns per content hash in an
+    SQLite table. Scores of another model, backend or model version live next to them
+    under their own key and are never returned for this one.
+
+    Attributes:
+        path (Path): The SQLite database.
+        model (str): The model the scores belong to, e.g. "detoxify-unbiased/torch/0.5.2".
+        columns (tuple[str, ...]): The names of the scores.
+    """
+
+    def __init__(self, path: Path, model: str, columns: tuple[str, ...]) -> None:
+        self.path = path
+        self.model = model
+        self.columns = columns
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS scores (
+                model TEXT NOT NULL,
+                hash BLOB NOT NULL,
+                {", ".join(f"{column} REAL NOT NULL" for column in columns)},
+                PRIMARY KEY (model, hash)
+            ) WITHOUT ROWID
+            """
+        )
+        self._db.commit()
+
+    def get(self, hashes: list[bytes]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Looks up the scores of posts.
+
+        Args:
+            hashes (list[bytes]): The content hashes of the posts (see `content_hash`).
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Whether every post was found, and a float32
+                array with a row per post and a column per score. Rows of posts not
+                found are undefined.
+        """
+        found = np.zeros(len(hashes), dtype=bool)
+        scores = np.empty((len(hashes), len(self.columns)), dtype=np.float32)
+        position = {key: i for i, key in enumerate(hashes)}
+        for start in range(0, len(hashes), LOOKUP_CHUNK):
+            chunk = hashes[start : start + LOOKUP_CHUNK]
+            rows = self._db.execute(
+                f"SELECT hash, {', '.join(self.columns)} FROM scores "
+                f"WHERE model = ? AND hash IN ({', '.join('?' * len(chunk))})",
+                (self.model, *chunk),
+            )
+            for key, *values in rows:
+                found[position[key]] = True
+                scores[position[key]] = values
+        return found, scores
+
+    def put(self, hashes: list[bytes], scores: np.ndarray) -> None:
+        """Stores the scores of posts, a row per content hash, and commits them."""
+        placeholders = ", ".join("?" * (len(self.columns) + 2))
+        self._db.executemany(
+            f"INSERT OR REPLACE INTO scores (model, hash, {', '.join(self.columns)}) "
+            f"VALUES ({placeholders})",
+            ((self.model, key, *row) for key, row in zip(hashes, scores.tolist())),
+        )
+        self._db.commit()
+
+    def __len__(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM scores WHERE model = ?", (self.model,)
+        ).fetchone()[0]
+
+    def close(self) -> None:
+        self._db.close()
@@ -1,37 +1,562 @@
+import importlib.metadata
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
+import psutil
 import torch
+import torch.multiprocessing
 from detoxify import Detoxify
 
-from src.utils import print_progress_bar
+from src.analysis.score_cache import ScoreCache, content_hash
+from src.utils import ProgressReporter
+
+SCORE_COLUMNS = ("toxicity", "severe_toxicity", "sexual_explicit")
+TOKEN_BUDGET = 16_384  # tokens per batch, padding included
+MAX_BATCH_SIZE = 256
+WINDOW_SIZE = 50_000  # posts tokenized and bucketed together, bounds the memory held
+# Intra-op threads on CPU. Hyper-threads only add contention to the matrix products
+CPU_THREADS = psutil.cpu_count(logical=False) or 1
+TOXICITY_WORKERS = 1  # processes scoring shards of the posts on CPU, 1 scores in this one
+# "torch" is the reference model. The others are faster on CPU at a small deviation
+# of the scores, measure it with benchmark_toxicity.py
+BACKENDS = ("torch", "quantized", "onnx", "onnx-quantized")
+MODEL_DIR = Path("data/models")  # ONNX exports of the model
+SCORE_CACHE = Path("data/score_cache.sqlite")  # scores of every post scored so far
+# Scored once by `ToxicityEngine.warm_up`: a short and a long batch
+WARM_UP_TEXTS = ("a short post",) * 8 + ("a post of a few hundred words " * 60,) * 2
+
+
+def length_batches(
+    lengths: np.ndarray,
+    token_budget: int = TOKEN_BUDGET,
+    max_batch_size: int = MAX_BATCH_SIZE,
+) -> list[np.ndarray]:
+    """
+    Groups posts of similar token length into batches, so that little of a batch is
+    padding. Short posts go in large batches and long posts in small ones: a batch holds
+    as many posts as fit in `token_budget` once padded to its longest post.
+
+    Args:
+        lengths (np.ndarray): The number of tokens of every post.
+        token_budget (int): The maximum number of tokens of a padded batch.
+        max_batch_size (int): The maximum number of posts of a batch.
+
+    Returns:
+        list[np.ndarray]: The row indices of the posts of every batch, shortest first.
+    """
+    order = np.argsort(lengths, kind="stable")
+    batches = []
+    start = 0
+    while start < len(order):
+        end = start + 1
+        # Sorted by length, so the post added last sets the padded length of the batch
+        while (
+            end < len(order)
+            and end - start < max_batch_size
+            and (end - start + 1) * lengths[order[end]] <= token_budget
+        ):
+            end += 1
+        batches.append(order[start:end])
+        start = end
+    return batches
+
+
+class ToxicityEngine:
+    """
+    Batched inference of a Detoxify model. Posts are tokenized once, bucketed by length
+    (see `length_batches`) and run without autograd, and the scores are written into a
+    preallocated array in the order of the posts. Posts are processed in windows of
+    `window_size`, so that only the token ids of one window are held at a time.
+
+    Attributes:
+        model (Detoxify): The model to score with.
+        token_budget (int): The maximum number of tokens of a padded batch.
+        max_batch_size (int): The maximum number of posts of a batch.
+        threads (int): The intra-op threads of torch while scoring on CPU.
+        window_size (int): The number of posts tokenized and bucketed together.
+        warm (bool): Whether the engine has scored posts, so that its first batches no
+            longer pay for lazy initialization.
+    """
+
+    def __init__(
+        self,
+        model: Detoxify,
+        token_budget: int = TOKEN_BUDGET,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        threads: int = CPU_THREADS,
+        window_size: int = WINDOW_SIZE,
+    ) -> None:
+        self.model = model
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.threads = threads
+        self.window_size = window_size
+        self.warm = False
+        self._columns = [model.class_names.index(name) for name in SCORE_COLUMNS]
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.model.device
+
+    def predict(self, texts: list[str], progress: bool = False) -> np.ndarray:
+        """
+        Scores the posts.
+
+        Args:
+            texts (list[str]): The posts.
+            progress (bool): Whether to print a progress bar.
+
+        Returns:
+            np.ndarray: A float32 array with a row per post and a column per score in
+                SCORE_COLUMNS.
+        """
+        scores = np.empty((len(texts), len(SCORE_COLUMNS)), dtype=np.float32)
+        if not texts:
+            return scores
+        tokenizer = self.model.tokenizer
+        reporter = ProgressReporter(len(texts), prefix="Scoring:") if progress else None
+
+        threads = torch.get_num_threads()
+        if self.device.type == "cpu":
+            torch.set_num_threads(self.threads)
+        self.model.model.eval()
+        try:
+            with torch.inference_mode():
+                for start in range(0, len(texts), self.window_size):
+                    window = texts[start : start + self.window_size]
+                    input_ids = tokenizer(window, truncation=True)["input_ids"]
+                    lengths = np.fromiter(map(len, input_ids), np.int64, len(window))
+                    for batch in length_batches(
+                        lengths, self.token_budget, self.max_batch_size
+                    ):
+                        inputs = tokenizer.pad(
+                            {"input_ids": [input_ids[j] for j in batch]},
+                            return_tensors="np",
+                        )
+                        scores[start + batch] = self._forward(dict(inputs))
+                        if reporter is not None:
+                            reporter.update(len(batch))
+        finally:
+            torch.set_num_threads(threads)
+        self.warm = True
+        return scores
+
+    def warm_up(self) -> None:
+        """Scores WARM_UP_TEXTS, unless the engine has scored posts already."""
+        if not self.warm:
+            self.predict(list(WARM_UP_TEXTS))
+
+    def _forward(self, inputs: dict[str, np.ndarray]) -> np.ndarray:
+        """Returns the scores of a padded batch."""
+        tensors = {
+            name: torch.from_numpy(array).to(self.device) for name, array in inputs.items()
+        }
+        logits = self.model.model(**tensors)[0][:, self._columns]
+        return torch.sigmoid(logits).float().cpu().numpy()
+
+
+class OnnxToxicityEngine(ToxicityEngine):
+    """
+    Runs an ONNX export of the model (see `export_onnx`) with ONNX Runtime on CPU. The
+    Detoxify model still provides the tokenizer and the names of the scores.
+
+    Attributes:
+        session (onnxruntime.InferenceSession): The exported model.
+    """
+
+    def __init__(
+        self,
+        model: Detoxify,
+        path: Path,
+        token_budget: int = TOKEN_BUDGET,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        threads: int = CPU_THREADS,
+    ) -> None:
+        import onnxruntime  # only needed by the ONNX backends
+
+        super().__init__(model, token_budget, max_batch_size, threads)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            str(path), options, providers=["CPUExecutionProvider"]
+        )
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device("cpu")
+
+    def _forward(self, inputs: dict[str, np.ndarray]) -> np.ndarray:
+        logits = self.session.run(["logits"], inputs)[0][:, self._columns]
+        return (1 / (1 + np.exp(-logits))).astype(np.float32)
+
+
+class _Logits(torch.nn.Module):
+    """Wraps the transformer so that its export takes and returns plain tensors."""
+
+    def __init__(self, model: torch.nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.model(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=False
+        )[0]
+
+
+def export_onnx(model: Detoxify, path: Path) -> None:
+    """
+    Exports the transformer of a Detoxify model to ONNX, with dynamic batch and sequence
+    dimensions. The file is written under a temporary name and renamed into place, so a
+    reader never opens a partly written export.
+
+    Args:
+        model (Detoxify): The model to export.
+        path (Path): Where to write the export.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    example = model.tokenizer(["an example post"], return_tensors="pt")
+    model.model.eval()
+    temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with torch.inference_mode():
+        torch.onnx.export(
+            _Logits(model.model),
+            (example["input_ids"], example["attention_mask"]),
+            str(temporary),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch"},
+            },
+            opset_version=17,
+        )
+    os.replace(temporary, path)
+
+
+def quantize_onnx(path: Path, quantized: Path) -> None:
+    """
+    Writes an int8 dynamically quantized copy of an ONNX export, under a temporary name
+    that is renamed into place like in `export_onnx`.
+
+    Args:
+        path (Path): The fp32 export.
+        quantized (Path): Where to write the quantized copy.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    temporary = quantized.with_name(f"{quantized.name}.{os.getpid()}.tmp")
+    quantize_dynamic(path, temporary, weight_type=QuantType.QInt8)
+    os.replace(temporary, quantized)
+
+
+def prepare_onnx(
+    backend: str, model: Detoxify | None = None, model_dir: Path = MODEL_DIR
+) -> Path:
+    """
+    Returns the ONNX export an "onnx" or "onnx-quantized" backend runs. The fp32 export
+    is only written if it is not in `model_dir` yet (see `export_onnx`), and the int8
+    copy only quantized from it if that is missing (see `quantize_onnx`).
+
+    Args:
+        backend (str): "onnx" or "onnx-quantized".
+        model (Detoxify | None): The model to export. Loaded on CPU if needed and not
+            given.
+        model_dir (Path): The directory of the ONNX exports.
+    """
+    path = model_dir / "detoxify-unbiased.onnx"
+    quantized = path.with_stem(path.stem + "-int8")
+    if backend == "onnx-quantized" and quantized.exists():
+        return quantized
+    if not path.exists():
+        print(f"Exporting the model to {path}")
+        if model is None:
+            model = Detoxify("unbiased", device="cpu")
+        export_onnx(model, path)
+    if backend != "onnx-quantized":
+        return path
+    print(f"Quantizing the model to {quantized}")
+    quantize_onnx(path, quantized)
+    return quantized
+
 
+def load_engine(
+    backend: str = "torch",
+    device: str | None = None,
+    threads: int = CPU_THREADS,
+    model_dir: Path = MODEL_DIR,
+) -> ToxicityEngine:
+    """
+    Loads the "unbiased" Detoxify model with one of the BACKENDS:
+    - "torch": the reference model, on the GPU if there is one.
+    - "quantized": the Linear layers dynamically quantized to int8 by torch, on CPU.
+    - "onnx": an ONNX export run by ONNX Runtime, on CPU.
+    - "onnx-quantized": the ONNX export with int8 weights, on CPU.
+    The ONNX exports are written to `model_dir` the first time they are needed.
 
-def compute_toxicity_and_sexuality_scores(data: pd.DataFrame) -> pd.DataFrame:
-    """Toxicity analysis using Detoxify. Modifies the passed dataframe in place, adding to it the toxicity scores."""
-    # A naive implementation. May crash with large datasets -> partition if needed
+    Args:
+        backend (str): One of BACKENDS.
+        device (str | None): The torch device of the reference model. Defaults to CUDA
+            if available.
+        threads (int): The intra-op threads on CPU.
+        model_dir (Path): The directory of the ONNX exports.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    model = Detoxify("unbiased", device=_device(backend, device))
+    if backend == "quantized":
+        model.model = torch.ao.quantization.quantize_dynamic(
+            model.model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif backend.startswith("onnx"):
+        export = prepare_onnx(backend, model, model_dir)
+        return OnnxToxicityEngine(model, export, threads=threads)
+    return ToxicityEngine(model, threads=threads)
+
+
+def _device(backend: str, device: str | None) -> str:
+    if backend != "torch":
+        return "cpu"
+    return device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+
+# The engines loaded by this process, by backend and device
+_engines: dict[tuple[str, str], ToxicityEngine] = {}
+
+
+def get_engine(
+    backend: str = "torch",
+    device: str | None = None,
+    threads: int = CPU_THREADS,
+    warm_up: bool = False,
+) -> ToxicityEngine:
+    """
+    Returns the engine of a backend shared by the whole process, loading the model the
+    first time it is asked for (see `load_engine`). Later calls skip reading the
+    checkpoint and setting up the tokenizer.
+
+    Args:
+        backend (str): One of BACKENDS.
+        device (str | None): The torch device of the reference model. Defaults to CUDA
+            if available.
+        threads (int): The intra-op threads on CPU, from now on.
+        warm_up (bool): Whether to score a few posts first if the engine has not yet.
+    """
+    key = (backend, _device(backend, device))
+    engine = _engines.get(key)
+    if engine is None:
+        engine = _engines[key] = load_engine(backend, key[1], threads)
+    engine.threads = threads
+    if warm_up:
+        engine.warm_up()
+    return engine
+
+
+def score_deviation(scores: np.ndarray, reference: np.ndarray) -> dict[str, float]:
+    """
+    Compares scores with those of the reference model on the same posts.
+
+    Returns:
+        dict[str, float]: For every score in SCORE_COLUMNS, the mean and the maximum
+            absolute difference, and the fraction of posts on the other side of 0.5.
+    """
+    difference = np.abs(scores - reference)
+    flipped = (scores >= 0.5) != (reference >= 0.5)
+    deviation = {}
+    for i, column in enumerate(SCORE_COLUMNS):
+        deviation[f"{column}_mean"] = float(difference[:, i].mean())
+        deviation[f"{column}_max"] = float(difference[:, i].max())
+        deviation[f"{column}_flipped"] = float(flipped[:, i].mean())
+    return deviation
+
+
+@dataclass(slots=True)
+class ShardReport:
+    """
+    Attributes:
+        shard (int): The position of the shard in the posts.
+        pid (int): The id of the worker process that scored it.
+        threads (int): The intra-op threads of the worker.
+        posts (int): The number of posts in the shard.
+        seconds (float): The time spent scoring them, without loading the model.
+    """
+
+    shard: int
+    pid: int
+    threads: int
+    posts: int
+    seconds: float
+
+    @property
+    def per_second(self) -> float:
+        return self.posts / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"shard {self.shard:>3} (pid {self.pid}, {self.threads} threads): "
+            f"{self.posts} posts in {self.seconds:.1f} s, {self.per_second:.1f} posts/s"
+        )
+
+
+# The engine of a worker process, set up once by _init_worker
+_engine: ToxicityEngine | None = None
+
+
+def _init_worker(
+    cores: "multiprocessing.Queue[list[int]]",
+    threads: int,
+    backend: str,
+    model: Detoxify | None,
+) -> None:
+    global _engine
+    if hasattr(os, "sched_setaffinity"):
+        # Give every worker its own cores, so their threads do not compete
+        os.sched_setaffinity(0, cores.get())
+    torch.set_num_threads(threads)
+    if model is not None:
+        # The weights of the model of the main process, in shared memory
+        _engines[(backend, "cpu")] = ToxicityEngine(model, threads=threads)
+    _engine = get_engine(backend, "cpu", threads, warm_up=True)
+
+
+def _score_shard(shard: int, texts: list[str]) -> tuple[np.ndarray, ShardReport]:
+    assert _engine is not None
+    start = time.perf_counter()
+    scores = _engine.predict(texts)
+    seconds = time.perf_counter() - start
+    return scores, ShardReport(shard, os.getpid(), _engine.threads, len(texts), seconds)
+
+
+def score_sharded(
+    texts: list[str], workers: int, threads: int | None = None, backend: str = "torch"
+) -> tuple[np.ndarray, list[ShardReport]]:
+    """
+    Scores the posts on CPU in `workers` processes, each with its own model and a share
+    of the cores. Every worker gets one contiguous shard of the posts, and the scores
+    are put back together in the order of the posts.
+
+    Args:
+        texts (list[str]): The posts.
+        workers (int): The number of worker processes.
+        threads (int | None): The intra-op threads of every worker. Defaults to an even
+            split of CPU_THREADS.
+        backend (str): One of BACKENDS (see `load_engine`).
+
+    Returns:
+        tuple[np.ndarray, list[ShardReport]]: The scores as returned by
+            `ToxicityEngine.predict` and how fast every shard was scored.
+    """
+    threads = threads or max(1, CPU_THREADS // workers)
+    # Spawned rather than forked: forking after torch has started its thread pool hangs.
+    # The workers share the weights of the reference model with this process instead of
+    # each reading the checkpoint: torch passes tensors in shared memory by handle.
+    # Quantized weights and ONNX sessions cannot be shared that way, so the workers load
+    # those themselves.
+    context = torch.multiprocessing.get_context("spawn")
+    model = None
+    if backend == "torch":
+        model = get_engine(backend, "cpu").model
+        model.model.share_memory()
+    elif backend.startswith("onnx"):
+        # Exported here before the workers start, so that they do not all write it
+        prepare_onnx(backend)
+    cores = context.Queue()
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    for share in np.array_split(np.array(available, dtype=int), workers):
+        cores.put(share.tolist() or available)
+    bounds = np.linspace(0, len(texts), workers + 1).astype(int)
+    shards = [texts[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    with ProcessPoolExecutor(
+        workers, mp_context=context, initializer=_init_worker, initargs=(cores, threads, backend, model)
+    ) as executor:
+        results = list(executor.map(_score_shard, range(workers), shards))
+    scores = np.concatenate([shard_scores for shard_scores, _ in results])
+    return scores, [report for _, report in results]
+
+
+def model_key(backend: str) -> str:
+    """Identifies the scores of a backend in the score cache, down to the Detoxify version."""
+    return f"detoxify-unbiased/{backend}/{importlib.metadata.version('detoxify')}"
+
+
+def _score(texts: list[str], workers: int, threads: int | None, backend: str) -> np.ndarray:
+    if not texts:
+        return np.empty((0, len(SCORE_COLUMNS)), dtype=np.float32)
+    on_cpu = backend != "torch" or not torch.cuda.is_available()
+    if workers > 1 and on_cpu:
+        print(f"Computing toxicity scores of {len(texts)} posts in {workers} processes")
+        start = time.perf_counter()
+        scores, reports = score_sharded(texts, workers, threads, backend)
+        for report in reports:
+            print(report)
+        seconds = time.perf_counter() - start
+        print(f"{len(texts) / seconds:.1f} posts/s overall, model loading included")
+        return scores
+    engine = get_engine(backend, threads=threads or CPU_THREADS)
+    print(
+        f"Computing toxicity scores of {len(texts)} posts with {engine.device} "
+        f"({backend})"
+    )
+    return engine.predict(texts, progress=True)
+
+
+def compute_toxicity_and_sexuality_scores(
+    data: pd.DataFrame,
+    workers: int = TOXICITY_WORKERS,
+    threads: int | None = None,
+    backend: str = "torch",
+    cache_path: Path | None = SCORE_CACHE,
+) -> pd.DataFrame:
+    """
+    Toxicity analysis using Detoxify. Returns the dataframe with the toxicity scores added.
+
+    Every distinct content is scored once, and scores are looked up in the score cache
+    first, so only contents that no run has scored with this backend are run through
+    the model. Their scores are added to the cache.
+
+    Args:
+        data (pd.DataFrame): The posts, with a "content" column.
+        workers (int): The number of processes to score on when there is no GPU. With
+            more than 1, the posts are sharded across them (see `score_sharded`).
+        threads (int | None): The intra-op threads per process on CPU. Defaults to an
+            even split of CPU_THREADS.
+        backend (str): One of BACKENDS (see `load_engine`). All but "torch" run on CPU.
+        cache_path (Path | None): The score cache, None to score every post.
+    """
     # Check if data parameter has any non-string in "content" column
     # count NaNs in content column
     if data["content"].isnull().sum() > 0:
         raise ValueError("Dataframe contains NaNs in content column")
 
-    model = Detoxify("unbiased", device="cuda" if torch.cuda.is_available() else "cpu")
-    # partition data into smaller chunks and process them individually, then concatenate the results
-    chunk_size = 100
-    chunks = [data.iloc[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
-    print(
-        "Computing toxicity scores in {} chunks with {}".format(
-            len(chunks), model.device
-        )
-    )
-    print_progress_bar(0, len(chunks))
-    for i, chunk in enumerate(chunks):
-        scores = model.predict(chunk["content"].tolist())
-        chunk["severe_toxicity"] = scores["severe_toxicity"]
-        chunk["toxicity"] = scores["toxicity"]
-        chunk["sexual_explicit"] = scores["sexual_explicit"]
-        print_progress_bar(i + 1, len(chunks))
-
-    # concatenate the chunks back into the original dataframe
-    data = pd.concat(chunks)
+    # Copypasta and short replies repeat a lot, score each distinct content once
+    codes, contents = pd.factorize(data["content"])
+    texts: list[str] = contents.tolist()
+    if cache_path is None:
+        scores = _score(texts, workers, threads, backend)
+    else:
+        cache = ScoreCache(cache_path, model_key(backend), SCORE_COLUMNS)
+        try:
+            hashes = [content_hash(text) for text in texts]
+            found, scores = cache.get(hashes)
+            missing = np.flatnonzero(~found)
+            print(
+                f"{len(data)} posts, {len(texts)} distinct, "
+                f"{len(texts) - len(missing)} in the score cache"
+            )
+            if len(missing):
+                new = _score([texts[i] for i in missing], workers, threads, backend)
+                scores[missing] = new
+                cache.put([hashes[i] for i in missing], new)
+        finally:
+            cache.close()
+    for i, column in enumerate(SCORE_COLUMNS):
+        data[column] = scores[codes, i]
     return data
 
 
@@ -46,5 +571,5 @@ if __name__ == "__main__":
         columns=["content"],
     )
     print(df)
-    compute_toxicity_and_sexuality_scores(df)
+    df = compute_toxicity_and_sexuality_scores(df)
     print(df)
@@ -0,0 +1,221 @@
+"""
+Benchmarks of the scraper hot paths.
+
+Microbenchmarks time the extraction of posts and threads on fixture pages: recorded
+thread pages from a page cache when available, generated ones otherwise. The end-to-end
+benchmark crawls a local mock forum with `Website.load_forum` and reports pages per
+second, peak memory and CPU utilization. Run with `python benchmark_scraper.py`.
+"""
+
+import asyncio
+import contextlib
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+import psutil
+
+from src.scraper.cache import PageCache
+from src.scraper.forum import Website
+from src.scraper.mock_forum import MockForum, MockForumConfig, index_page, thread_page
+from src.scraper.parsers import POST_PARSERS
+from src.scraper.pipeline import PARSE_WORKERS
+
+SAMPLE_INTERVAL = 0.1  # seconds between samples of memory and CPU
+
+
+@dataclass(slots=True)
+class BenchmarkResult:
+    """
+    Attributes:
+        name (str): What was measured.
+        items (int): The number of pages processed per run.
+        seconds (float): The best wall time of the runs.
+        peak_rss (int): The peak resident memory in bytes of the process and its
+            workers, 0 if not sampled.
+        cpu_utilization (float): The CPU time used per second of wall time, divided by
+            the number of CPUs, 0 if not sampled.
+    """
+
+    name: str
+    items: int
+    seconds: float
+    peak_rss: int = 0
+    cpu_utilization: float = 0.0
+
+    @property
+    def per_second(self) -> float:
+        return self.items / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        line = f"{self.name:<32} {self.per_second:>10.1f} pages/s  {self.seconds:>8.3f} s"
+        if self.peak_rss:
+            line += f"  peak RSS {self.peak_rss / 2**20:.0f} MiB"
+            line += f"  CPU {self.cpu_utilization:.0%}"
+        return line
+
+
+class ResourceSampler:
+    """
+    Samples the resident memory and CPU time of this process and its children from a
+    background thread, so worker processes are accounted for too.
+
+    Attributes:
+        interval (float): The seconds between samples.
+        exclude (set[int]): The ids of child processes not to account for.
+        peak_rss (int): The highest total resident memory sampled, in bytes.
+        cpu_seconds (float): The CPU time used between entering and exiting.
+    """
+
+    def __init__(
+        self, interval: float = SAMPLE_INTERVAL, exclude: set[int] | None = None
+    ) -> None:
+        self.interval = interval
+        self.exclude = exclude or set()
+        self.peak_rss = 0
+        self.cpu_seconds = 0.0
+        self._process = psutil.Process()
+        self._cpu: dict[int, float] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self) -> None:
+        rss = 0
+        for process in [self._process, *self._process.children(recursive=True)]:
+            if process.pid in self.exclude:
+                continue
+            with contextlib.suppress(psutil.Error):
+                with process.oneshot():
+                    rss += process.memory_info().rss
+                    cpu = process.cpu_times()
+                    # Keep the last reading of processes that have exited meanwhile
+                    self._cpu[process.pid] = cpu.user + cpu.system
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self) -> "ResourceSampler":
+        self._sample()
+        self._start_cpu = sum(self._cpu.values())
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        self.cpu_seconds = sum(self._cpu.values()) - self._start_cpu
+
+
+def best_of(func: Callable[[], Any], repeat: int) -> float:
+    """Returns the best wall time of `repeat` calls of `func` in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def load_fixtures(
+    cache_dir: Path | None = None, limit: int = 200, config: MockForumConfig | None = None
+) -> list[bytes]:
+    """
+    Returns thread pages to benchmark the parsers on: up to `limit` recorded pages from
+    a page cache, or pages generated like the mock forum serves them if there are none.
+    """
+    if cache_dir is not None and (cache_dir / "index.sqlite").exists():
+        cache = PageCache(cache_dir)
+        try:
+            pages = [cache.get(url) for url in cache.urls(limit)]
+        finally:
+            cache.close()
+        if pages:
+            return pages  # type: ignore
+    config = config or MockForumConfig()
+    pages = []
+    for thread_id in range(1, config.threads + 1):
+        for page in range(1, config.thread_pages(thread_id) + 1):
+            pages.append(thread_page(config, thread_id, page).encode())
+            if len(pages) == limit:
+                return pages
+    return pages
+
+
+def benchmark_extraction(
+    website: Website, pages: list[bytes], repeat: int = 3
+) -> list[BenchmarkResult]:
+    """
+    Times `extract_posts_from_html` with every parser backend on one core,
+    `extract_posts_from_html_chunk` on the worker processes and
+    `extract_threads_from_html` on index pages.
+    """
+    results = []
+    parser = website.parser
+    for name in POST_PARSERS:
+        website.parser = name
+        with contextlib.redirect_stdout(None):
+            seconds = best_of(
+                lambda: [website.extract_posts_from_html(page) for page in pages], repeat
+            )
+        results.append(
+            BenchmarkResult(f"extract_posts_from_html[{name}]", len(pages), seconds)
+        )
+    website.parser = parser
+
+    with contextlib.redirect_stdout(None):
+        website.extract_posts_from_html_chunk(pages[:1])  # start the workers
+        seconds = best_of(lambda: website.extract_posts_from_html_chunk(pages), repeat)
+    results.append(BenchmarkResult("extract_posts_from_html_chunk", len(pages), seconds))
+
+    config = MockForumConfig(threads=len(pages) * 20)
+    index = [index_page(config, i) for i in range(1, config.index_pages + 1)]
+    with contextlib.redirect_stdout(None):
+        seconds = best_of(lambda: website.extract_threads_from_html(index), repeat)
+    results.append(BenchmarkResult("extract_threads_from_html", len(index), seconds))
+    return results
+
+
+def benchmark_crawl(config: MockForumConfig, parser: str = "lxml") -> BenchmarkResult:
+    """
+    Crawls a mock forum with `Website.load_forum` in a temporary directory and measures
+    the thread pages fetched and parsed per second, the peak memory and the CPU
+    utilization of the crawl, including the worker processes.
+    """
+    mock = MockForum(config)
+    with (
+        mock as url,
+        tempfile.TemporaryDirectory() as directory,
+        contextlib.chdir(directory),
+    ):
+        website = Website(url, journal_path=Path("journal.sqlite"), parser=parser)
+        # Start the workers before timing
+        list(website.executor.map(int, range(PARSE_WORKERS)))
+
+        async def crawl() -> None:
+            try:
+                await website.load_forum("benchmark", 1)
+            finally:
+                await website.close_session()
+
+        Path("data").mkdir()
+        sampler = ResourceSampler(exclude={mock.pid})  # type: ignore
+        with contextlib.redirect_stdout(None), sampler:
+            start = time.perf_counter()
+            asyncio.run(crawl())
+            seconds = time.perf_counter() - start
+        website.close()
+    return BenchmarkResult(
+        f"load_forum[{parser}, {config.latency * 1000:.0f} ms]",
+        config.total_thread_pages + config.index_pages,
+        seconds,
+        sampler.peak_rss,
+        sampler.cpu_seconds / seconds / (os.cpu_count() or 1),
+    )
+
@@ -0,0 +1,232 @@
+import mmap
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+
+import zstandard
+
+SEGMENT_SIZE = 1 << 30  # bytes of compressed pages per segment file
+COMPRESSION_LEVEL = 3
+
+PageLocation = tuple[str, int, int]
+"""Where a compressed page is stored: segment path, offset and length."""
+
+# Memory maps of the segments opened by this process, reused across reads
+_segments: dict[str, mmap.mmap] = {}
+
+
+def read_page(location: PageLocation) -> bytes:
+    """
+    Reads and decompresses one cached page through a memory map of its segment.
+
+    A module-level function of the location only, so worker processes can read pages
+    straight from the segment files instead of receiving them from the main process.
+    """
+    path, offset, length = location
+    segment = _segments.get(path)
+    if segment is None or len(segment) < offset + length:
+        # Segments only grow, so a map that is too short is replaced by a longer one
+        if segment is not None:
+            segment.close()
+        with open(path, "rb") as f:
+            segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _segments[path] = segment
+    return zstandard.ZstdDecompressor().decompress(segment[offset : offset + length])
+
+
+class PageCache:
+    """
+    On-disk cache of raw pages keyed by url, so pages can be parsed again without
+    fetching them.
+
+    Every page is compressed with zstd into its own frame and appended to the current
+    segment file; a new segment is started once it reaches `segment_size` bytes. An
+    SQLite index maps each url to the segment, offset and length of its frame, and
+    pages are read back through memory maps of the segments. Storing a url again
+    appends the new version and points the index at it. Safe to use from several
+    threads, so that it can be flushed off the event loop.
+
+    Attributes:
+        directory (Path): The directory holding the segments and the index.
+        segment_size (int): The size in bytes after which a new segment is started.
+    """
+
+    def __init__(self, directory: Path, segment_size: int = SEGMENT_SIZE) -> None:
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self._compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+        self._db = sqlite3.connect(directory / "index.sqlite", check_same_thread=False)
+        self._lock = threading.RLock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                forum TEXT NOT NULL,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                fetched REAL NOT NULL,
+                etag TEXT,
+                last_modified TEXT
+            )
+            """
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(pages)")}
+        for column in ("etag", "last_modified"):
+            if column not in columns:
+                # Indexes created before validators were stored
+                self._db.execute(f"ALTER TABLE pages ADD COLUMN {column} TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pages_forum ON pages (forum)")
+        self._db.commit()
+        segments = sorted(directory.glob("segment-*.zst"))
+        self._segment_number = len(segments) - 1
+        self._segment = None
+        self._pending: list[tuple] = []  # index rows of pages not flushed yet
+
+    def _segment_path(self, number: int) -> Path:
+        return self.directory / f"segment-{number:05d}.zst"
+
+    def _open_segment(self):
+        if self._segment is None or self._segment.tell() >= self.segment_size:
+            if self._segment is not None:
+                self._segment.close()
+            if self._segment_number < 0 or (
+                self._segment_path(self._segment_number).stat().st_size
+                >= self.segment_size
+            ):
+                self._segment_number += 1
+            self._segment = open(self._segment_path(self._segment_number), "ab")
+        return self._segment
+
+    def put(
+        self,
+        url: str,
+        page: str | bytes,
+        forum: str,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> None:
+        """
+        Appends a page to the current segment. It is visible to `get` once `flush` is
+        called.
+
+        Args:
+            url (str): The url the page was fetched from.
+            page (str | bytes): The raw page. Text is stored as UTF-8.
+            forum (str): The forum the page belongs to, e.g. "the-lounge.4".
+            etag (str | None): The ETag header of the response.
+            last_modified (str | None): The Last-Modified header of the response.
+        """
+        if isinstance(page, str):
+            page = page.encode("utf-8")
+        frame = self._compressor.compress(page)
+        with self._lock:
+            segment = self._open_segment()
+            offset = segment.tell()
+            segment.write(frame)
+            self._pending.append(
+                (
+                    url,
+                    forum,
+                    Path(segment.name).name,
+                    offset,
+                    len(frame),
+                    time.time(),
+                    etag,
+                    last_modified,
+                )
+            )
+
+    def flush(self) -> None:
+        """
+        Writes the appended pages to disk and then records them in the index, so the
+        index never points at data that is not on disk.
+        """
+        with self._lock:
+            if self._segment is not None:
+                self._segment.flush()
+            if self._pending:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO pages (url, forum, segment, offset, "
+                        "length, fetched, etag, last_modified) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        self._pending,
+                    )
+                self._pending.clear()
+
+    def location(self, url: str) -> PageLocation | None:
+        """Returns where the page of a url is stored, or None if it is not cached."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT segment, offset, length FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        segment, offset, length = row
+        return str(self.directory / segment), offset, length
+
+    def validators(self, url: str) -> tuple[str | None, str | None] | None:
+        """
+        Returns the ETag and Last-Modified headers the cached page of a url was served
+        with, or None if it is not cached.
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT etag, last_modified FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+
+    def get(self, url: str) -> bytes | None:
+        """Returns the cached page of a url, or None if it is not cached."""
+        location = self.location(url)
+        return read_page(location) if location else None
+
+    def locations(self, forum: str) -> list[tuple[str, PageLocation]]:
+        """
+        Returns the url and location of every cached page of a forum, in the order they
+        are stored so the segments are read sequentially.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT url, segment, offset, length FROM pages WHERE forum = ? "
+                "ORDER BY segment, offset",
+                (forum,),
+            ).fetchall()
+        return [
+            (url, (str(self.directory / segment), offset, length))
+            for url, segment, offset, length in rows
+        ]
+
+    def urls(self, limit: int | None = None) -> list[str]:
+        """Returns the cached urls in the order they are stored, at most `limit`."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT url FROM pages ORDER BY segment, offset LIMIT ?",
+                (-1 if limit is None else limit,),
+            )
+            return [url for (url,) in rows]
+
+    def pages(self, forum: str) -> Iterator[tuple[str, bytes]]:
+        """Yields the url and page of every cached page of a forum."""
+        for url, location in self.locations(forum):
+            yield url, read_page(location)
+
+    def __contains__(self, url: str) -> bool:
+        return self.location(url) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self) -> None:
+        """Flushes pending pages and closes the segment and the index."""
+        with self._lock:
+            self.flush()
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            self._db.close()
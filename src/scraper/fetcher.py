@@ -1,70 +1,674 @@
 import asyncio
+import contextlib
+import math
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
 
 import aiohttp
 
-from src.utils import print_progress_bar
+from src.scraper.metrics import METRICS
+from src.utils import ProgressReporter
 
-BATCH_FETCHES = 50
-BATCH_DELAY = 0.5  # seconds
+INITIAL_CONCURRENCY = 10
+MAX_CONCURRENCY = 100
+INITIAL_RATE = 20.0  # requests per second
+MAX_RATE = 200.0  # requests per second
+RATE_GROWTH = 0.1  # of the rate per window of healthy requests, after slow start
+TARGET_LATENCY = 2.0  # seconds
+LIMIT_PER_HOST = MAX_CONCURRENCY
+DNS_CACHE_TTL = 600  # seconds
+KEEPALIVE_TIMEOUT = 60  # seconds
+REQUEST_TIMEOUT = 60.0  # seconds
+RETRIES = 4
+BACKOFF = 1.0  # seconds before the first retry, doubled for every further retry
+MAX_BACKOFF = 60.0  # seconds
+ACCEPT_ENCODING = "br, gzip"  # br needs the Brotli package to be decoded
 
+T = TypeVar("T")
 
-async def fetch(session: aiohttp.ClientSession, url: str) -> str:
+
+class ConnectionStats:
+    """
+    Counts how often the connection pool of a session opens new connections versus
+    reusing kept-alive ones.
+
+    Attributes:
+        requests (int): The number of requests sent.
+        created (int): The number of new TCP/TLS connections opened.
+        reused (int): The number of requests sent over a pooled connection.
+        dns_hits (int): The number of host lookups answered by the DNS cache.
+        dns_misses (int): The number of host lookups that went to the resolver.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Returns a trace config that updates these counters for a session."""
+
+        async def on_request_start(*_: object) -> None:
+            self.requests += 1
+
+        async def on_connection_create_end(*_: object) -> None:
+            self.created += 1
+
+        async def on_connection_reuseconn(*_: object) -> None:
+            self.reused += 1
+
+        async def on_dns_cache_hit(*_: object) -> None:
+            self.dns_hits += 1
+
+        async def on_dns_cache_miss(*_: object) -> None:
+            self.dns_misses += 1
+
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(on_request_start)
+        config.on_connection_create_end.append(on_connection_create_end)
+        config.on_connection_reuseconn.append(on_connection_reuseconn)
+        config.on_dns_cache_hit.append(on_dns_cache_hit)
+        config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return config
+
+    @property
+    def reuse_ratio(self) -> float:
+        """The share of connections that were taken from the pool."""
+        total = self.created + self.reused
+        return self.reused / total if total else 0.0
+
+    def report(self) -> str:
+        """Returns a one-line summary of the connection reuse."""
+        return (
+            f"{self.requests} requests over {self.created} new connections, "
+            f"{self.reused} reused ({self.reuse_ratio:.1%}), "
+            f"DNS cache {self.dns_hits} hits / {self.dns_misses} misses"
+        )
+
+
+def create_session(
+    stats: ConnectionStats | None = None,
+    limit_per_host: int = LIMIT_PER_HOST,
+    compress: bool = True,
+) -> aiohttp.ClientSession:
+    """
+    Creates a client session meant to be kept open for a whole crawl, so that TCP/TLS
+    connections and DNS lookups are reused between requests.
+
+    Args:
+        stats (ConnectionStats | None): Counters to update with the connection reuse.
+        limit_per_host (int): The maximum number of open connections to one host.
+        compress (bool): Whether to ask the server for compressed responses.
+
+    Returns:
+        aiohttp.ClientSession: The new session. Must be closed by the caller.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=max(limit_per_host, MAX_CONCURRENCY),
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True,
+    )
+    headers = {"Accept-Encoding": ACCEPT_ENCODING if compress else "identity"}
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=headers,
+        auto_decompress=compress,
+        trace_configs=[stats.trace_config()] if stats is not None else None,
+    )
+
+
+class RateController:
+    """
+    Adaptive limit on the number of requests in flight and the request rate.
+
+    Requests are admitted by a semaphore of `concurrency` slots and a token bucket that
+    refills at `rate` tokens per second. Starting like TCP slow start, both limits are
+    doubled after every window of `concurrency` healthy responses until the server
+    first signals overload, and from then on grow by one slot and `RATE_GROWTH` of the
+    rate per window.
+
+    Overload is answered at most once per window: only requests started after the last
+    decrease can cause another one, so a burst of failures, or the retries of a URL
+    that keeps failing, halve the limits once. A 5xx response or a failed connection
+    halves the concurrency, and a 429 or a `Retry-After` header also halves the rate and
+    pauses new requests until the requested time has passed. A response slower than
+    `target_latency` lowers the concurrency by one slot.
+
+    Attributes:
+        concurrency (int): The current number of requests allowed in flight.
+        rate (float): The current number of requests allowed per second.
+        completed (int): The number of finished requests.
+        errors (int): The number of requests that signaled overload.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = INITIAL_CONCURRENCY,
+        max_concurrency: int = MAX_CONCURRENCY,
+        rate: float = INITIAL_RATE,
+        max_rate: float = MAX_RATE,
+        target_latency: float = TARGET_LATENCY,
+    ) -> None:
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.completed = 0
+        self.errors = 0
+        self._in_flight = 0
+        self._healthy_streak = 0
+        self._tokens = 1.0
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._slow_start = True
+        self._started = time.monotonic()
+        self._slots = asyncio.Condition()
+        self._notifying: set[asyncio.Task[None]] = set()
+
+    async def __aenter__(self) -> "RateController":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc: object) -> None:
+        await self.release()
+
+    async def acquire(self, admit: Callable[[], bool] | None = None) -> None:
+        """
+        Waits for a free slot and a token of the rate limit, and takes them.
+
+        Args:
+            admit (Callable[[], bool] | None): A further condition for taking a slot.
+                It is called with the controller's lock held whenever a slot may have
+                become free, and the slot is taken in the same step once it returns
+                True, so it may also count the admission. Callers whose condition
+                changes without a slot being released call `notify`.
+        """
+        async with self._slots:
+            await self._slots.wait_for(
+                lambda: self._in_flight < self.concurrency and (admit is None or admit())
+            )
+            self._in_flight += 1
+        try:
+            await self._take_token()
+        except BaseException:
+            await self.release()
+            raise
+
+    async def release(self) -> None:
+        """Gives back a slot taken by `acquire`."""
+        async with self._slots:
+            self._in_flight -= 1
+            self._slots.notify_all()
+
+    async def notify(self) -> None:
+        """Wakes the requests waiting in `acquire` to check their conditions again."""
+        async with self._slots:
+            self._slots.notify_all()
+
+    def _wake_waiters(self) -> None:
+        # record is synchronous, so the requests waiting for a slot are woken by a task
+        task = asyncio.get_running_loop().create_task(self.notify())
+        self._notifying.add(task)
+        task.add_done_callback(self._notifying.discard)
+
+    async def _take_token(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(
+                max(self.rate, 1.0), self._tokens + (now - self._refilled) * self.rate
+            )
+            self._refilled = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+    def record(
+        self,
+        latency: float,
+        status: int,
+        retry_after: float | None = None,
+        retry: bool = False,
+    ) -> None:
+        """
+        Records the outcome of a request and adapts the limits to it.
+
+        Args:
+            latency (float): The time the request took in seconds.
+            status (int): The HTTP status of the response, 0 if none was received.
+            retry_after (float | None): The `Retry-After` delay in seconds, if sent.
+            retry (bool): Whether the request retried a failed one. Its failure only
+                repeats a signal that was already answered.
+        """
+        self.completed += 1
+        now = time.monotonic()
+        throttled = status == 429 or retry_after is not None
+        if throttled or status == 0 or status >= 500:
+            self.errors += 1
+            self._healthy_streak = 0
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if retry or now - latency < self._last_decrease:
+                return
+            self._last_decrease = now
+            self._slow_start = False
+            self.concurrency = max(1, self.concurrency // 2)
+            if throttled:
+                self.rate = max(1.0, self.rate / 2)
+        elif latency > self.target_latency:
+            self._healthy_streak = 0
+            if now - latency >= self._last_decrease:
+                self._last_decrease = now
+                self.concurrency = max(1, self.concurrency - 1)
+        else:
+            # Grow once per window of healthy requests
+            self._healthy_streak += 1
+            if self._healthy_streak >= self.concurrency:
+                self._healthy_streak = 0
+                if self._slow_start:
+                    concurrency = self.concurrency * 2
+                    rate = self.rate * 2
+                else:
+                    concurrency = self.concurrency + 1
+                    rate = self.rate * (1 + RATE_GROWTH)
+                if self.concurrency < self.max_concurrency:
+                    self.concurrency = min(self.max_concurrency, concurrency)
+                    self._wake_waiters()
+                self.rate = min(self.max_rate, rate)
+
+    @property
+    def requests_per_second(self) -> float:
+        """The achieved request rate since the controller was created."""
+        elapsed = time.monotonic() - self._started
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        """Returns a one-line summary of the achieved throughput and current limits."""
+        return (
+            f"{self.requests_per_second:.1f} req/s over {self.completed} requests "
+            f"({self.errors} overloaded), concurrency {self.concurrency}, "
+            f"rate limit {self.rate:.1f}/s"
+        )
+
+
+class FairShare:
+    """
+    Splits the slots of one RateController between several crawls, so that a crawl
+    with many pages queued cannot starve the others. The shared controller keeps the
+    total request rate within one politeness budget.
+
+    The split is work-conserving: the slots are divided evenly only between the crawls
+    that are using or waiting for them. A crawl that is busy parsing, or whose fetchers
+    wait for the parsers, leaves its share to the others, and a crawl may borrow free
+    slots beyond its share as long as no crawl below its share is waiting for them.
+
+    Attributes:
+        limiter (RateController): The controller whose slots are shared.
+    """
+
+    def __init__(self, limiter: RateController) -> None:
+        self.limiter = limiter
+        self._in_flight: dict[str, int] = {}
+        self._waiting: dict[str, int] = {}
+
+    def quota(self) -> int:
+        """The number of requests each crawl using the network may have in flight."""
+        active = sum(
+            1 for name, n in self._in_flight.items() if n or self._waiting[name]
+        )
+        return max(1, math.ceil(self.limiter.concurrency / max(1, active)))
+
+    def limiter_for(self, name: str) -> "SharedLimiter":
+        """Registers a crawl and returns the limiter its requests go through."""
+        self._in_flight[name] = 0
+        self._waiting[name] = 0
+        return SharedLimiter(self, name)
+
+    def _may_start(self, name: str) -> bool:
+        quota = self.quota()
+        if self._in_flight[name] < quota:
+            return True
+        # Borrow a free slot, unless a crawl below its share is waiting for it
+        return not any(
+            self._waiting[other] and self._in_flight[other] < quota
+            for other in self._in_flight
+            if other != name
+        )
+
+    async def _acquire(self, name: str) -> None:
+        admitted = False
+
+        def admit() -> bool:
+            # Counted in the step the controller hands out the slot
+            nonlocal admitted
+            if not self._may_start(name):
+                return False
+            self._in_flight[name] += 1
+            admitted = True
+            return True
+
+        self._waiting[name] += 1
+        try:
+            await self.limiter.acquire(admit)
+        except BaseException:
+            if admitted:
+                self._in_flight[name] -= 1
+            raise
+        finally:
+            self._waiting[name] -= 1
+
+    async def _release(self, name: str) -> None:
+        self._in_flight[name] -= 1
+        await self.limiter.release()
+
+    async def _leave(self, name: str) -> None:
+        # Hand the share of a finished crawl to the remaining ones
+        self._in_flight.pop(name, None)
+        self._waiting.pop(name, None)
+        await self.limiter.notify()
+
+
+class SharedLimiter:
+    """
+    The limiter of one crawl in a FairShare. Used like a RateController.
+
+    Attributes:
+        name (str): The name of the crawl.
+        completed (int): The number of finished requests of this crawl.
+    """
+
+    def __init__(self, share: FairShare, name: str) -> None:
+        self.share = share
+        self.name = name
+        self.completed = 0
+        self._started = time.monotonic()
+
+    @property
+    def max_concurrency(self) -> int:
+        return self.share.limiter.max_concurrency
+
+    async def __aenter__(self) -> "SharedLimiter":
+        await self.share._acquire(self.name)
+        return self
+
+    async def __aexit__(self, *exc: object) -> None:
+        await self.share._release(self.name)
+
+    def record(
+        self,
+        latency: float,
+        status: int,
+        retry_after: float | None = None,
+        retry: bool = False,
+    ) -> None:
+        """Records the outcome of a request with the shared controller."""
+        self.completed += 1
+        self.share.limiter.record(latency, status, retry_after, retry)
+
+    async def close(self) -> None:
+        """Leaves the share once the crawl is done."""
+        await self.share._leave(self.name)
+
+    def report(self) -> str:
+        """Returns the throughput of this crawl and of the shared controller."""
+        elapsed = time.monotonic() - self._started
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        return f"{self.name} {rate:.1f} req/s, all crawls {self.share.limiter.report()}"
+
+
+Limiter = RateController | SharedLimiter
+"""Anything requests can be admitted through."""
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Parses a `Retry-After` header given in seconds. HTTP dates are ignored.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Tells whether a failed request is worth retrying: timeouts, connection errors, 429
+    and 5xx responses are. Other error statuses, like 404, are not.
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+@dataclass(slots=True)
+class FetchedPage:
+    """
+    The raw response to a possibly conditional request.
+
+    Attributes:
+        body (bytes | None): The undecoded page, None if the server answered
+            304 Not Modified.
+        etag (str | None): The ETag header of the response.
+        last_modified (str | None): The Last-Modified header of the response.
+    """
+
+    body: bytes | None
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+async def _read_text(response: aiohttp.ClientResponse) -> str:
+    return await response.text()
+
+
+async def _read_page(response: aiohttp.ClientResponse) -> FetchedPage:
+    return FetchedPage(
+        None if response.status == 304 else await response.read(),
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
+
+
+async def _get(
+    session: aiohttp.ClientSession,
+    url: str,
+    limiter: Limiter | None,
+    timeout: float,
+    read: Callable[[aiohttp.ClientResponse], Awaitable[T]],
+    headers: dict[str, str] | None = None,
+    attempt: int = 0,
+) -> T:
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with limiter if limiter is not None else contextlib.nullcontext():
+        start = time.monotonic()
+        METRICS.inc("fetch_requests_total")
+        try:
+            async with session.get(
+                url, timeout=client_timeout, headers=headers
+            ) as response:
+                latency = time.monotonic() - start
+                METRICS.observe("fetch_latency_seconds", latency)
+                METRICS.inc(f'http_responses_total{{status="{response.status}"}}')
+                if limiter is not None:
+                    limiter.record(
+                        latency,
+                        response.status,
+                        parse_retry_after(response.headers.get("Retry-After")),
+                        attempt > 0,
+                    )
+                if response.status not in (200, 304):
+                    response.raise_for_status()
+                result = await read(response)
+                # Counts the decompressed body
+                METRICS.inc("fetch_bytes_total", response.content.total_bytes)
+                return result
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            METRICS.inc(f'fetch_errors_total{{error="{type(e).__name__}"}}')
+            if limiter is not None:
+                limiter.record(time.monotonic() - start, 0, retry=attempt > 0)
+            raise
+
+
+async def _retrying(request: Callable[[int], Awaitable[T]], retries: int) -> T:
+    # Retries transient failures with exponential backoff and full jitter, waiting at
+    # least as long as a Retry-After header asks for. The request is passed the number
+    # of the attempt.
+    attempt = 0
+    while True:
+        try:
+            return await request(attempt)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            delay = min(MAX_BACKOFF, BACKOFF * 2**attempt) * random.random()
+            if isinstance(e, aiohttp.ClientResponseError) and e.headers:
+                delay = max(delay, parse_retry_after(e.headers.get("Retry-After")) or 0.0)
+            attempt += 1
+            METRICS.inc("fetch_retries_total")
+            await asyncio.sleep(delay)
+
+
+async def fetch(
+    session: aiohttp.ClientSession,
+    url: str,
+    limiter: Limiter | None = None,
+    retries: int = RETRIES,
+    timeout: float = REQUEST_TIMEOUT,
+) -> str:
     """
     Fetches the content of a URL using an asynchronous HTTP GET request.
 
+    Transient failures are retried with exponential backoff and full jitter, waiting at
+    least as long as a `Retry-After` header asks for. The request slot is given back
+    while waiting.
+
     Args:
         session (aiohttp.ClientSession): The aiohttp client session to use for the request.
         url (str): The URL to fetch.
+        limiter (Limiter | None): The controller admitting the request, if any.
+            It is fed the latency and status of the response.
+        retries (int): How many times a transient failure is retried.
+        timeout (float): The time limit of each attempt in seconds.
 
     Returns:
         str: The content of the URL.
 
     Raises:
         aiohttp.ClientResponseError: If the response status is not 200.
+        aiohttp.ClientError: If the request fails for other reasons.
+        asyncio.TimeoutError: If the last attempt timed out.
+    """
+    return await _retrying(
+        lambda attempt: _get(session, url, limiter, timeout, _read_text, None, attempt),
+        retries,
+    )
+
+
+async def fetch_page(
+    session: aiohttp.ClientSession,
+    url: str,
+    limiter: Limiter | None = None,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    retries: int = RETRIES,
+    timeout: float = REQUEST_TIMEOUT,
+) -> FetchedPage:
+    """
+    Fetches the raw bytes of a URL, conditionally on the validators of a stored copy.
+
+    With an `etag` or `last_modified` the request carries If-None-Match and
+    If-Modified-Since, so an unchanged page comes back as 304 without a body. The body
+    is not decoded, which leaves charset detection to parsers that take bytes. Retried
+    like `fetch`.
+
+    Args:
+        session (aiohttp.ClientSession): The aiohttp client session to use for the request.
+        url (str): The URL to fetch.
+        limiter (Limiter | None): The controller admitting the request, if any.
+        etag (str | None): The ETag of the stored copy.
+        last_modified (str | None): The Last-Modified date of the stored copy.
+        retries (int): How many times a transient failure is retried.
+        timeout (float): The time limit of each attempt in seconds.
+
+    Returns:
+        FetchedPage: The body and validators of the response. The body is None if the
+            stored copy is still current.
+
+    Raises:
+        aiohttp.ClientResponseError: If the response status is not 200 or 304.
+        aiohttp.ClientError: If the request fails for other reasons.
+        asyncio.TimeoutError: If the last attempt timed out.
     """
-    async with session.get(url) as response:
-        if response.status != 200:
-            response.raise_for_status()
-        return await response.text()
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return await _retrying(
+        lambda attempt: _get(
+            session, url, limiter, timeout, _read_page, headers, attempt
+        ),
+        retries,
+    )
 
 
-async def fetch_all(session: aiohttp.ClientSession, urls: list[str]) -> list[str]:
+async def fetch_all(
+    session: aiohttp.ClientSession,
+    urls: list[str],
+    limiter: Limiter | None = None,
+) -> tuple[list[str], list[str]]:
     """
     Fetches multiple URLs asynchronously using the provided aiohttp ClientSession.
 
+    The urls are fetched through a sliding window: a new request starts as soon as the
+    controller admits it, so one slow page never holds back the others. A url that still
+    fails after its retries is put on the dead-letter list instead of aborting the rest.
+
     Args:
         session (aiohttp.ClientSession): The aiohttp ClientSession to use for making requests.
         urls (list[str]): A list of URLs to fetch.
+        limiter (Limiter | None): The controller to share with other fetches.
+            A new one is created if not given.
 
     Returns:
-        list[str]: A list of fetched responses.
-
-    """
-    results: list[str] = []
-    chunks: list[list[str]] = []
-    if len(urls) > BATCH_FETCHES:
-        for i in range(0, len(urls), BATCH_FETCHES):
-            chunks.append(urls[i : i + BATCH_FETCHES])
-    else:
-        chunks.append(urls)
-
-    batch_fetch = False
-    if len(chunks) > 1:
-        batch_fetch = True
-        print(
-            f"Fetching urls in {len(chunks)} chunks of {BATCH_FETCHES} w/ {BATCH_DELAY}s delay..."
-        )
+        tuple[list[str], list[str]]: The successfully fetched responses in the order
+            of their urls, and the urls that failed for good. Failed urls have no
+            response, so positions in the first list do not match those in `urls`.
 
-    for i, chunk in enumerate(chunks):
-        tasks: list[asyncio.Task[str]] = []
-        for url in chunk:
-            task = asyncio.create_task(fetch(session, url))
-            tasks.append(task)
-        chunk_results = await asyncio.gather(*tasks)
-        results += chunk_results
-        if batch_fetch:
-            await asyncio.sleep(BATCH_DELAY)
-            print_progress_bar(
-                i + 1, len(chunks), prefix="Fetching:", suffix="complete", decimals=2
-            )
-    return results
+    """
+    if limiter is None:
+        limiter = RateController()
+    results: list[str | None] = [None] * len(urls)
+    failed: list[str] = []
+    pending = iter(enumerate(urls))
+    progress = ProgressReporter(len(urls) if len(urls) > 1 else 0, prefix="Fetching:")
+
+    async def worker() -> None:
+        for i, url in pending:
+            try:
+                results[i] = await fetch(session, url, limiter)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"\nGiving up on {url}: {e!r}")
+                failed.append(url)
+            progress.update()
+
+    async with asyncio.TaskGroup() as group:
+        for _ in range(min(limiter.max_concurrency, len(urls))):
+            group.create_task(worker())
+    if len(urls) > 1:
+        print(f"Fetched {len(urls)} urls at {limiter.report()}")
+    return [result for result in results if result is not None], failed
@@ -1,15 +1,44 @@
 import asyncio
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
 from datetime import datetime
-from multiprocessing import Pool
+from functools import partial
 from pathlib import Path
+from typing import Callable
 
 import aiohttp
 import pandas as pd
 from bs4 import BeautifulSoup
 
-from src.scraper.fetcher import fetch_all
-from src.utils import print_progress_bar
+from src.scraper.cache import PageCache
+from src.scraper.fetcher import (
+    ConnectionStats,
+    FairShare,
+    Limiter,
+    RateController,
+    SharedLimiter,
+    create_session,
+    fetch_all,
+)
+from src.scraper.journal import CrawlJournal
+from src.scraper.metrics import METRICS, report_periodically, serve_metrics, timed
+from src.scraper.models import Forum, Post, PostBatch, Thread
+from src.scraper.parsers import (
+    POST_PARSERS,
+    PostRow,
+    extract_cached_post_rows,
+    extract_post_rows,
+    extract_threads,
+)
+from src.scraper.pipeline import PARSE_WORKERS, run_pipeline
+from src.scraper.sink import ParquetSink
+from src.utils import ProgressReporter
+
+DUMP_ROWS = 20_000  # posts held in memory before they are dumped to disk
+POSTS_DUMP_DIR = Path("data/posts_dump")
+JOURNAL_PATH = Path("data/crawl_journal.sqlite")
+CACHE_DIR = Path("data/page_cache")
+METRICS_LOG = Path("data/metrics.jsonl")
 
 
 class Website:
@@ -20,22 +49,124 @@ class Website:
         url (str): The URL of the website.
         forums (list[Forum]): A list of forums on the website.
         threads (list[Thread]): A list of threads on the website.
-        posts (list[Post]): A list of posts on the website.
+        posts (dict[str, PostBatch]): The posts of every forum crawled since the last
+            dump to disk.
+        sinks (dict[str, ParquetSink]): The dumped posts of every loaded forum.
+        connection_stats (ConnectionStats): Connection reuse counters of the session.
+        journal_path (Path): Where the journal of finished thread pages is kept.
+        parser (str): The backend used to extract posts, one of `POST_PARSERS`.
+        cache_dir (Path | None): Where the raw thread pages are cached for `reparse`.
+            Pages are not cached if None.
+        metrics_port (int | None): The port the crawl metrics are served on in the
+            Prometheus text format while crawling. They are always appended to
+            METRICS_LOG as JSON lines.
     
     """
-    def __init__(self, url: str) -> None:
+    def __init__(
+        self,
+        url: str,
+        journal_path: Path = JOURNAL_PATH,
+        parser: str = "lxml",
+        cache_dir: Path | None = None,
+        metrics_port: int | None = None,
+    ) -> None:
+        if parser not in POST_PARSERS:
+            raise ValueError(f"Unknown parser {parser}, expected one of {list(POST_PARSERS)}")
         self.url = url
+        self.parser = parser
         self.forums: list[Forum] = []
         self.threads: list[Thread] = []
-        self.posts: list[Post] = []
+        self.posts: dict[str, PostBatch] = {}
+        self.connection_stats = ConnectionStats()
+        self.journal_path = journal_path
+        self.cache_dir = cache_dir
+        self.metrics_port = metrics_port
+        self._session: aiohttp.ClientSession | None = None
+        self._executor: ProcessPoolExecutor | None = None
+        self._journal: CrawlJournal | None = None
+        self._cache: PageCache | None = None
+        self.sinks: dict[str, ParquetSink] = {}
+        self._forum_threads: dict[str, list[Thread]] = {}
+
+    @property
+    def post_parser(self) -> Callable[[str | bytes], list[Post]]:
+        """The post extraction function of the selected backend. Safe to send to workers."""
+        return POST_PARSERS[self.parser]
+
+    @property
+    def post_row_parser(self) -> Callable[[str | bytes], list[PostRow]]:
+        """
+        Extracts PostRows with the selected backend. Pickles by reference, so sending it
+        to the workers does not copy the Website.
+        """
+        return partial(extract_post_rows, parser=self.parser)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The client session shared by every request to the website. It is created on first
+        use inside the running event loop and kept open until `close_session` is called.
+        """
+        if self._session is None or self._session.closed:
+            self._session = create_session(self.connection_stats)
+        return self._session
+
+    async def close_session(self) -> None:
+        """Closes the shared client session and its pooled connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            print(f"Connections: {self.connection_stats.report()}")
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """
+        The worker processes that parse index and thread pages, started on first use and
+        kept until `close` is called.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(PARSE_WORKERS)
+        return self._executor
+
+    def close(self) -> None:
+        """Stops the parser processes and closes the journal and the page cache."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+    @property
+    def journal(self) -> CrawlJournal:
+        """The journal of finished thread pages, opened on first use."""
+        if self._journal is None:
+            self._journal = CrawlJournal(self.journal_path)
+        return self._journal
+
+    @property
+    def cache(self) -> PageCache | None:
+        """The cache of raw thread pages, opened on first use. None if disabled."""
+        if self._cache is None and self.cache_dir is not None:
+            self._cache = PageCache(self.cache_dir)
+        return self._cache
     
-    def load_and_save_forum(self, label: str, id: int) -> None:
+    def load_and_save_forum(self, label: str, id: int, incremental: bool = False) -> None:
         """
         Loads and saves a forum with the given label and ID.
 
+        If a previous run of the same forum failed, the thread pages it already finished
+        are skipped and its dumped posts are kept. The journal of the forum is cleared
+        once the forum has been saved.
+
         Args:
             label (str): The label of the forum.
             id (int): The ID of the forum.
+            incremental (bool): Only crawl threads that are new or changed since the
+                previous crawl of the forum. See `load_forum`.
 
         Raises:
             ValueError: If the label contains spaces.
@@ -43,53 +174,137 @@ class Website:
         Returns:
             None
         """
-        if " " in label:
-            raise ValueError("Label cannot contain spaces")
+        self.load_and_save_forums([(label, id)], incremental)
+
+    def load_and_save_forums(
+        self, forums: list[tuple[str, int]], incremental: bool = False
+    ) -> None:
+        """
+        Loads and saves several forums concurrently in one event loop.
+
+        All forums share the client session, the parser processes and one RateController,
+        so together they stay within a single politeness budget. Its request slots are
+        split evenly between the forums with requests in flight or waiting, so a forum
+        that is busy parsing leaves its share of the network to the others (see
+        `FairShare`).
+
+        Args:
+            forums (list[tuple[str, int]]): The label and ID of every forum.
+            incremental (bool): See `load_and_save_forum`.
+
+        Raises:
+            ValueError: If a label contains spaces.
+
+        Returns:
+            None
+        """
+        for label, _ in forums:
+            if " " in label:
+                raise ValueError("Label cannot contain spaces")
+
+        async def crawl() -> None:
+            share = FairShare(RateController())
+            limiters = [share.limiter_for(f"{label}.{id}") for label, id in forums]
+            reporter = asyncio.create_task(report_periodically(METRICS_LOG))
+            server = None
+            if self.metrics_port is not None:
+                server = await serve_metrics(self.metrics_port)
+            try:
+                await asyncio.gather(
+                    *(
+                        self._load_and_save_forum(label, id, incremental, limiter)
+                        for (label, id), limiter in zip(forums, limiters)
+                    )
+                )
+            finally:
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+                if server is not None:
+                    await server.cleanup()
+                await self.close_session()
+
+        asyncio.run(crawl())
+
+    async def _load_and_save_forum(
+        self, label: str, id: int, incremental: bool, limiter: SharedLimiter
+    ) -> None:
         path: Path = Path(f"data/")
         save_label: str = f"{label}_{datetime.now().strftime(r"%Y-%m-%d_%H.%M.%S")}"
+        forum = f"{label}.{id}"
 
         start = datetime.now()
         try:
-            asyncio.run(self.load_forum(label, id))
+            failed = await self.load_forum(label, id, incremental, limiter)
         except Exception as e:
             # dump saved stuff to disk
-            print("Error loading forum: ", e)
-            self.threads_as_dataframe().to_csv(
-                path / f"ERROR_threads_{save_label}.csv.zip"
+            print(f"Error loading forum {forum}: ", e)
+            print("Finished thread pages are journaled, run again to resume")
+            await asyncio.to_thread(
+                self.threads_as_dataframe(forum).to_csv,
+                path / f"ERROR_threads_{save_label}.csv.zip",
             )
-            self.posts_as_dataframe().to_csv(
-                path / f"ERROR_posts_{save_label}.csv.zip "
+            posts = await asyncio.to_thread(self.posts_as_dataframe, forum)
+            await asyncio.to_thread(
+                posts.to_csv, path / f"ERROR_posts_{save_label}.csv.zip "
             )
             return
+        finally:
+            await limiter.close()
         print(
             "\nLoading forum {} took {} seconds".format(
                 label, (datetime.now() - start).seconds
             )
         )
-        threads = self.threads_as_dataframe()
+        threads = self.threads_as_dataframe(forum)
         print(threads)
-        posts = self.posts_as_dataframe()
+        # Read and written in a thread, so the other forums keep crawling meanwhile
+        posts = await asyncio.to_thread(self.posts_as_dataframe, forum)
         print(posts)
-        threads.to_csv(path / f"threads_{save_label}.csv.zip")
-        posts.to_csv(path / f"posts_{save_label}.csv.zip")
-
-    async def load_forum(self, label: str, id: int) -> None:
+        await asyncio.to_thread(threads.to_csv, path / f"threads_{save_label}.csv.zip")
+        await asyncio.to_thread(posts.to_csv, path / f"posts_{save_label}.csv.zip")
+        if failed:
+            print(f"{len(failed)} pages of {forum} could not be fetched")
+            (path / f"failed_urls_{save_label}.txt").write_text("\n".join(failed) + "\n")
+        self.journal.clear(forum)
+
+    async def load_forum(
+        self,
+        label: str,
+        id: int,
+        incremental: bool = False,
+        limiter: Limiter | None = None,
+    ) -> list[str]:
             """
             Loads a forum with the specified label and ID.
 
+            Pages that still fail after retrying are skipped and returned as dead
+            letters instead of aborting the crawl.
+
             Args:
                 label (str): The label of the forum.
                 id (int): The ID of the forum.
+                incremental (bool): Compare the forum index against the threads snapshot
+                    of the previous crawl and only fetch new threads and the tail pages
+                    of threads that grew. The new posts are merged into the previously
+                    dumped posts, replacing older versions of the same posts.
+                limiter (Limiter | None): The controller admitting the requests, shared
+                    with other crawls. A new one is created if not given.
 
             Returns:
-                None
+                list[str]: The urls of the index and thread pages that could not be
+                    fetched.
+
+            Raises:
+                RuntimeError: If the first page of the forum could not be fetched.
             """
             print(f"Loading forum {label}.{id}...")
-            
+            forum = f"{label}.{id}"
+            if limiter is None:
+                limiter = RateController()
             urls = [self.url + f"/forums/{label}.{id}?order=post_date&direction=asc"]
-            pages_html: list[str] = []
-            async with aiohttp.ClientSession() as session:
-                pages_html += await fetch_all(session, urls)
+            pages_html, failed = await fetch_all(self.session, urls, limiter)
+            if failed:
+                raise RuntimeError(f"Could not fetch the first page of {forum}")
 
             # Parse the html to get the number of pages
             soup = BeautifulSoup(pages_html[0], "html.parser")
@@ -103,155 +318,212 @@ class Website:
             ]
 
             print(f"Fetching {len(urls)+1} pages...")
-            async with aiohttp.ClientSession() as session:
-                pages_html = await fetch_all(session, urls)
+            index_html, failed = await fetch_all(self.session, urls, limiter)
+            pages_html += index_html
+            if failed:
+                print(f"Missing the threads of {len(failed)} index pages of {forum}")
 
-            # Parse the html to get the threads
-            _threads = self.extract_threads_from_html(pages_html)
+            # Parse the html to get the threads. Waits for the parser processes in a
+            # thread, so the event loop keeps serving the other forums meanwhile
+            _threads = await asyncio.to_thread(self.extract_threads_from_html, pages_html)
 
             self.threads += _threads # Add to total threads
-            print("Threads:", len(_threads))
-
-            # dump threads to disk
-            self.threads_as_dataframe().to_csv(f"data/threads_{label}_{id}.csv.zip")
-            
-            # Get thread paged urls
-            urls = self.generate_thread_urls(_threads)
-
-            # Chunk the urls into batches of 10000
-            urls_chunked: list[list[str]] = []
-            for i in range(0, len(urls), 10000):
-                urls_chunked.append(urls[i : i + 10000])
-
-            starting_chunk = 0
-            # Drop starting_chunk number of chunks from the beginning
-            urls_chunked = urls_chunked[starting_chunk:]
-            
-            
-            for i, chunk in enumerate(urls_chunked):
-                print(f"Fetching {len(chunk)} thread pages chunked {i+1}/{len(urls_chunked)}...")
-                thread_html: list[str] = []
-                async with aiohttp.ClientSession() as session:
-                    thread_html += await fetch_all(session, chunk)
-
-                # Parse the html to get the posts
-                print(f"Parsing {len(thread_html)} thread pages in multiple threads...")
-                _posts = self.extract_posts_from_html_chunk(thread_html)
-                self.posts += _posts
-                self.dumb_posts_to_disk()
-    
-    def dumb_posts_to_disk(self) -> None:
-        # dump posts to disk, to the same file
-        df = self.posts_as_dataframe()
-        df.to_csv(f"data/posts_dump.csv.zip")
+            self._forum_threads[forum] = _threads
+            print(f"Threads in {forum}:", len(_threads))
+
+            snapshot = Path(f"data/threads_{label}_{id}.csv.zip")
+            start_pages: dict[int, int] | None = None
+            if incremental and snapshot.exists():
+                previous = pd.read_csv(snapshot, index_col="id")  # type: ignore
+                if "last_post" in previous.columns:
+                    previous["last_post"] = pd.to_datetime(previous["last_post"])
+                start_pages = self.plan_incremental_crawl(previous, _threads)
+                print(f"Incremental: {len(start_pages)} new or changed threads")
+            elif incremental:
+                print(f"Incremental: no snapshot at {snapshot}, crawling everything")
+
+            # Get thread paged urls, skipping the ones a failed run already finished
+            urls = self.generate_thread_urls(
+                [t for t in _threads if start_pages is None or t.id in start_pages],
+                start_pages,
+            )
+            finished = self.journal.urls(forum)
+            if not finished and start_pages is None:
+                # A fresh crawl replaces the posts dumped by earlier runs of the forum;
+                # resumed and incremental crawls add to them
+                self.sink(forum).clear()
+            if finished:
+                urls = [url for url in urls if url not in finished]
+                print(
+                    f"Resuming: skipping {len(finished)} finished thread pages "
+                    f"of {len(self.journal.thread_ids(forum))} threads"
+                )
 
-    def extract_posts_from_html_chunk(self, thread_html: list[str]):
+            # Stream the thread pages through fetch -> parse -> write so that only a
+            # bounded number of pages is held in memory at a time
+            print(f"Crawling {len(urls)} thread pages of {forum}...")
+            start = datetime.now()
+            self.posts[forum] = PostBatch()
+            unjournaled: list[tuple[str, int | None]] = []
+
+            def checkpoint() -> None:
+                # Journal the pages only once their posts and raw pages are on disk
+                self.dumb_posts_to_disk(forum)
+                if self.cache is not None:
+                    self.cache.flush()
+                self.journal.mark(forum, unjournaled)
+                unjournaled.clear()
+
+            async def write(url: str, rows: list[PostRow]) -> None:
+                self.posts[forum].append_rows(rows)
+                METRICS.inc("posts_parsed_total", len(rows))
+                unjournaled.append((url, rows[0][3] if rows else None))
+                if len(self.posts[forum]) >= DUMP_ROWS:
+                    # The Parquet write and the commits run in a thread, so the other
+                    # forums keep crawling meanwhile. The writer waits for it, so no
+                    # rows of this forum are appended in between
+                    await asyncio.to_thread(checkpoint)
+
+            failed += await run_pipeline(
+                self.session,
+                urls,
+                self.post_row_parser,
+                write,
+                self.executor,
+                limiter,
+                cache=self.cache,
+                forum=forum,
+            )
+            await asyncio.to_thread(checkpoint)
+            print(f"Crawled {len(urls)} thread pages of {forum} in {datetime.now() - start}")
+            print(f"Fetched at {limiter.report()}")
+
+            # dump threads to disk. Written last, so that it is the snapshot the next
+            # incremental crawl is compared against only once this crawl has finished.
+            # Threads with pages that could not be fetched are left out, so the next
+            # incremental crawl fetches them again
+            missing = {
+                int(url.split("/threads/")[1].split("/")[0].split(".")[-1])
+                for url in failed
+                if "/threads/" in url
+            }
+            threads = self.threads_as_dataframe(forum)
+            threads.drop(index=list(missing), errors="ignore").to_csv(snapshot)
+            return failed
+
+    def sink(self, forum: str) -> ParquetSink:
+        """Returns the sink of the posts of a forum, e.g. "the-lounge.4"."""
+        if forum not in self.sinks:
+            self.sinks[forum] = ParquetSink(POSTS_DUMP_DIR / forum)
+        return self.sinks[forum]
+
+    def dumb_posts_to_disk(self, forum: str) -> None:
         """
-        Extracts posts from HTML and returns a list of Post objects.
+        Appends the posts crawled since the last dump to the sink of the forum and
+        releases them from memory.
+        """
+        self.sink(forum).write(self.posts[forum])
+        self.posts[forum] = PostBatch()
+
+    def reparse(self, label: str, id: int) -> pd.DataFrame:
+        """
+        Rebuilds the posts of a forum from the cached thread pages, without any network
+        access, e.g. after the extraction rules changed. The workers read the pages from
+        the cache segments themselves. Replaces the dumped posts of the forum.
+
+        Args:
+            label (str): The label of the forum.
+            id (int): The ID of the forum.
+
+        Raises:
+            ValueError: If the page cache is disabled or holds no pages of the forum.
+
+        Returns:
+            pd.DataFrame: The rebuilt posts of the forum.
+        """
+        forum = f"{label}.{id}"
+        if self.cache is None:
+            raise ValueError("The page cache is disabled, pass a cache_dir")
+        self.cache.flush()
+        pages = self.cache.locations(forum)
+        if not pages:
+            raise ValueError(f"No cached pages of {forum} in {self.cache_dir}")
+
+        print(f"Reparsing {len(pages)} cached pages of {forum}...")
+        start = datetime.now()
+        self.sink(forum).clear()
+        self.posts[forum] = PostBatch()
+        progress = ProgressReporter(len(pages), prefix="Reparsing:")
+        parse = partial(timed, partial(extract_cached_post_rows, parser=self.parser))
+        chunksize = max(1, len(pages) // (4 * PARSE_WORKERS))
+        for rows, seconds in self.executor.map(
+            parse, [loc for _, loc in pages], chunksize=chunksize
+        ):
+            METRICS.observe("parse_page_seconds", seconds)
+            METRICS.inc("pages_parsed_total")
+            METRICS.inc("posts_parsed_total", len(rows))
+            self.posts[forum].append_rows(rows)
+            progress.update()
+            if len(self.posts[forum]) >= DUMP_ROWS:
+                self.dumb_posts_to_disk(forum)
+        self.dumb_posts_to_disk(forum)
+        print(f"Reparsed {len(pages)} pages of {forum} in {datetime.now() - start}")
+        return self.posts_as_dataframe(forum)
+
+    def extract_posts_from_html_chunk(self, thread_html: list[str] | list[bytes]):
+        """
+        Extracts posts from HTML on the worker processes and returns a list of Post
+        objects.
 
         Args:
-            thread_html (list[str]): A list of HTML strings representing the threads.
+            thread_html (list[str] | list[bytes]): A list of HTML pages of threads.
 
         Returns:
             list[Post]: A list of Post objects extracted from the HTML.
         """
+        start = datetime.now()
+        chunksize = max(1, len(thread_html) // (4 * PARSE_WORKERS))
         _posts: list[Post] = []
-        
-        with Pool() as pool:
-            start = datetime.now()
-            _posts_chunks = pool.map(self.extract_posts_from_html, thread_html)
-            for chunk in _posts_chunks:
-                _posts += chunk
-            print(f"Extracted {len(_posts)} posts in {datetime.now() - start} multi-core")
-                    
+        for rows, seconds in self.executor.map(
+            partial(timed, self.post_row_parser), thread_html, chunksize=chunksize
+        ):
+            METRICS.observe("parse_page_seconds", seconds)
+            _posts += [Post(*row) for row in rows]
+        METRICS.inc("pages_parsed_total", len(thread_html))
+        METRICS.inc("posts_parsed_total", len(_posts))
+        print(f"Extracted {len(_posts)} posts in {datetime.now() - start} multi-core")
         return _posts
-    
-    def extract_posts_from_html(self, html: str) -> list["Post"]:
+
+    def extract_posts_from_html(self, html: str | bytes) -> list[Post]:
         """
         Extracts posts from HTML and returns a list of Post objects.
         """
-        _posts: list[Post] = []
-        
-        soup = BeautifulSoup(html, "html.parser")
-        thread_id_src = soup.find_all(
-            "div", class_="block-container lbContainer", recursive=True
-        )[0].get("data-lb-id")
-        thread_id: int = int(thread_id_src.split("-")[-1])
-
-        first = soup.select(
-            "article.message.message--article.js-post.js-inlineModContainer.is-first",
-        )
-        if first:
-            # First post
-            post = first[0]
-            author = post.get("data-author")  # type: ignore
-            post_id = int(post.get("data-content").split("-")[-1])  # type: ignore
-            inner_bb = post.select("div.bbWrapper")[0]
-            for quote in inner_bb.find_all("blockquote"):
-                quote.decompose() # Remove quotes. TODO: images and videos
-            content = inner_bb.text
-            time_posted = datetime.fromisoformat(
-                post.select("time")[0].get("datetime")  # type: ignore
-            )
-            _posts.append(
-                Post(author, post_id, content, thread_id, time_posted)
-            )
-        # other posts
-        articles_cont = soup.select("div.block-body.js-replyNewMessageContainer")
-        if not articles_cont:
-            print(f"No articles found in thread {thread_id}")
-        else:
-            articles = articles_cont[0].select(
-                "article.message.message--post.js-post.js-inlineModContainer"
-            )
-            for article in articles:
-                author: str = article.get("data-author")  # type: ignore
-                post_id = int(article.get("data-content").split("-")[-1])  # type: ignore
-                inner_bb = article.select("div.bbWrapper")[0]
-
-                # remove quotes
-                for quote in inner_bb.find_all("blockquote"):
-                    quote.decompose()
-                # remove images
-                for img in inner_bb.select("div.bbImageWrapper"):
-                    img.decompose()
-                # remove inline videos
-                for video in inner_bb.select("div.bbMediaWrapper"):
-                    video.decompose()
-                # remove youtube videos
-                for video in inner_bb.select("span[data-s9e-mediaembed=\"youtube\"]"):
-                    video.decompose()
-                # remove embed websites
-                for embed in inner_bb.select("div.bbCodeBlock"):
-                    embed.decompose()
-                
-                content = inner_bb.text
-                time_posted = datetime.fromisoformat(
-                    article.select("time.u-dt")[0].get("datetime")  # type: ignore
-                )
-                _posts.append(
-                    Post(author, post_id, content, thread_id, time_posted)
-                )
-        return _posts
+        return self.post_parser(html)
 
-    def generate_thread_urls(self, threads: list["Thread"]):
+    def generate_thread_urls(
+        self, threads: list["Thread"], start_pages: dict[int, int] | None = None
+    ):
         """
         Generates a list of URLs for the given threads.
 
         Args:
             threads (list[Thread]): A list of Thread objects.
+            start_pages (dict[int, int] | None): The first page to generate per thread id.
+                Threads not in the dict start from the first page.
         
         Returns:
             list[str]: A list of URLs for the given threads.
         """
         urls: list[str] = []
         for thread in threads:
-            urls.append(
-                self.url
-                + f"/threads/{thread.url_label}.{thread.id}/?order=post_date&direction=asc"
-            )
+            start = start_pages.get(thread.id, 1) if start_pages else 1
+            if start <= 1:
+                urls.append(
+                    self.url
+                    + f"/threads/{thread.url_label}.{thread.id}/?order=post_date&direction=asc"
+                )
             if thread.pages > 1:
-                for i in range(2, thread.pages + 1):
+                for i in range(max(start, 2), thread.pages + 1):
                     urls.append(
                         self.url
                         + f"/threads/{thread.url_label}.{thread.id}/page-{i}?order=post_date&direction=asc"
@@ -259,6 +531,40 @@ class Website:
                     
         return urls
 
+    def plan_incremental_crawl(
+        self, previous: pd.DataFrame, threads: list["Thread"]
+    ) -> dict[int, int]:
+        """
+        Compares the threads of a forum index against the snapshot of a previous crawl.
+
+        New threads are crawled from the first page. Threads that gained pages or whose
+        last post changed are crawled from their previous last page, which may have
+        received new posts. Unchanged threads are left out.
+
+        Args:
+            previous (pd.DataFrame): The previous threads snapshot, indexed by thread id.
+            threads (list[Thread]): The threads parsed from the current index.
+
+        Returns:
+            dict[int, int]: The first page to crawl per id of a new or changed thread.
+        """
+        # A thread can be listed twice if the index pages shifted during the crawl
+        previous = previous[~previous.index.duplicated(keep="last")]
+        has_last_post = "last_post" in previous.columns
+        start_pages: dict[int, int] = {}
+        for thread in threads:
+            if thread.id not in previous.index:
+                start_pages[thread.id] = 1
+                continue
+            old = previous.loc[thread.id]
+            old_pages = int(old["pages"])
+            grew = thread.pages > old_pages
+            if has_last_post and thread.last_post and not pd.isna(old["last_post"]):
+                grew = grew or pd.Timestamp(thread.last_post) != old["last_post"]
+            if grew:
+                start_pages[thread.id] = min(old_pages, thread.pages)
+        return start_pages
+
     def extract_threads_from_html(self, pages_html: list[str]):
         """
         Extracts threads from HTML pages.
@@ -269,98 +575,51 @@ class Website:
         Returns:
             list[Thread]: A list of Thread objects extracted from the HTML pages.
         """
-        print(f"Parsing {len(pages_html)} pages...")
         _threads: list[Thread] = []
-        for i, html in enumerate(pages_html):
-            soup = BeautifulSoup(html, "html.parser")
-            thread_list = soup.find_all(
-                "div",
-                {"class": "js-threadList"},
-                recursive=True,
-            )[0]
-            threads = thread_list.find_all("div", recursive=False)
-            for thread in threads:
-                link = thread.find_all("a", {"data-tp-primary": "on"}, recursive=True)[
-                    0
-                ]
-                pages_cont = thread.find(
-                    "span", class_="structItem-pageJump", recursive=True
-                )
-                pages: int = 1
-                if pages_cont:
-                    pages = int(pages_cont.find_all("a", recursive=False)[-1].text)
-                href = link.get("href")
-                temp = href.split("/")[-2]
-                temp = temp.split(".")
-                id = int(temp[-1])
-                url_label = "".join(temp[:-1])
-                author: str = thread.get("data-author")
-                _threads.append(Thread(url_label, id, link.text, author, pages))
-            print(f"Parsed page {i + 1}/{len(pages_html)}...")
+        progress = ProgressReporter(len(pages_html), prefix="Parsing index:")
+        # Pages are submitted in chunks to keep the dispatch overhead low; map returns
+        # the results in page order
+        chunksize = max(1, len(pages_html) // (4 * PARSE_WORKERS))
+        for threads, seconds in self.executor.map(
+            partial(timed, extract_threads), pages_html, chunksize=chunksize
+        ):
+            METRICS.observe("parse_index_page_seconds", seconds)
+            _threads += threads
+            progress.update()
         return _threads
 
-
-
-    def threads_as_dataframe(self) -> pd.DataFrame:
+    def threads_as_dataframe(self, forum: str | None = None) -> pd.DataFrame:
             """
             Converts the threads data into a pandas DataFrame.
 
+            Args:
+                forum (str | None): Only include the threads of this forum, e.g.
+                    "the-lounge.4". All threads if not given.
+
             Returns:
                 pd.DataFrame: A DataFrame containing the threads data.
             """
-            df = pd.DataFrame(self.threads)
+            threads = self.threads if forum is None else self._forum_threads.get(forum, [])
+            df = pd.DataFrame(threads, columns=[f.name for f in fields(Thread)])
             df.set_index("id", drop=True, inplace=True)  # type: ignore
             return df
 
-    def posts_as_dataframe(self) -> pd.DataFrame:
+    def posts_as_dataframe(self, forum: str | None = None) -> pd.DataFrame:
             """
-            Converts the posts data into a pandas DataFrame. Drops duplicates based on the post id.
+            Converts the dumped and the not yet dumped posts into a pandas DataFrame. Drops
+            duplicates based on the post id, keeping the most recently crawled version.
+
+            Args:
+                forum (str | None): Only include the posts of this forum, e.g.
+                    "the-lounge.4". All posts if not given.
 
             Returns:
                 pd.DataFrame: A DataFrame containing the posts data.
             """
-            df = pd.DataFrame(self.posts)
-            df.drop_duplicates(subset="id", inplace=True)
+            forums = list(self.sinks.keys() | self.posts.keys()) if forum is None else [forum]
+            dfs = [self.sink(name).read() for name in forums]
+            dfs += [self.posts.get(name, PostBatch()).to_dataframe() for name in forums]
+            df = pd.concat(dfs, ignore_index=True)
+            df.drop_duplicates(subset="id", keep="last", inplace=True)
             df.set_index("id", drop=True, inplace=True)  # type: ignore
             return df
-
-
-@dataclass
-class Thread:
-    """Represents a thread in a forum"""
-
-    url_label: str
-    id: int
-    title: str
-    author: str
-    pages: int
-    scraped: datetime = datetime.now()
-    """The number of pages in the thread"""
-
-
-@dataclass
-class Forum:
-    """Represents a forum on a website"""
-
-    url_label: str
-    id: int
-    title: str
-    pages: int
-    """The number of pages in the forum"""
-
-
-@dataclass
-class Post:
-    """Represents a post in a forum thread"""
-
-    author: str
-    """The author of the post"""
-    id: int
-    """The id of the post"""
-    content: str
-    """The content of the post"""
-    thread_id: int
-    """The id of the thread to which this post belongs"""
-    date_posted: datetime
-    """The date the post was made"""
-
@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class CrawlJournal:
+    """
+    Persistent record of the thread pages a crawl has finished, stored in SQLite.
+
+    Pages are recorded per forum once their posts are safely on disk, so a crawl that is
+    restarted after a crash can skip them. The journal of a forum is cleared when its
+    crawl completes, so the next run starts fresh. Safe to use from several threads, so
+    that checkpoints can be written off the event loop.
+
+    Attributes:
+        path (Path): The path of the SQLite database.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                forum TEXT NOT NULL,
+                url TEXT NOT NULL,
+                thread_id INTEGER,
+                updated REAL NOT NULL,
+                PRIMARY KEY (forum, url)
+            )
+            """
+        )
+        self._db.commit()
+
+    def mark(self, forum: str, pages: list[tuple[str, int | None]]) -> None:
+        """
+        Records pages whose posts are on disk in one transaction.
+
+        Args:
+            forum (str): The forum the pages belong to, e.g. "the-lounge.4".
+            pages (list[tuple[str, int | None]]): Pairs of page url and thread id.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                [(forum, url, thread_id, now) for url, thread_id in pages],
+            )
+
+    def urls(self, forum: str) -> set[str]:
+        """Returns the urls of the finished pages of a forum."""
+        with self._lock:
+            rows = self._db.execute("SELECT url FROM pages WHERE forum = ?", (forum,))
+            return {url for (url,) in rows}
+
+    def thread_ids(self, forum: str) -> set[int]:
+        """Returns the ids of the threads with at least one finished page."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT DISTINCT thread_id FROM pages WHERE forum = ?", (forum,)
+            )
+            return {thread_id for (thread_id,) in rows if thread_id is not None}
+
+    def clear(self, forum: str) -> None:
+        """Forgets every page of a forum."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM pages WHERE forum = ?", (forum,))
+
+    def close(self) -> None:
+        """Closes the database."""
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,228 @@
+"""
+Telemetry of the crawl: counters, gauges and latency histograms.
+
+Every stage records into the process-wide `METRICS` registry, which can be rendered in
+the Prometheus text format, served over HTTP or appended to a log as JSON lines. Work
+done in worker processes is timed there with `timed` and recorded by the caller.
+"""
+
+import asyncio
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import psutil
+from aiohttp import web
+
+# Upper bounds of the histogram buckets in seconds, 0.1 ms to about 52 s
+BUCKETS = tuple(0.0001 * 2**i for i in range(20))
+PERCENTILES = (0.5, 0.9, 0.99)
+REPORT_INTERVAL = 10.0  # seconds between JSON lines
+
+
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets, cheap to update and to merge.
+
+    Attributes:
+        buckets (tuple[float, ...]): The upper bounds of the buckets.
+        counts (list[int]): The number of values per bucket, plus one for larger values.
+        count (int): The number of values observed.
+        sum (float): The sum of the values observed.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q: float) -> float:
+        """
+        Estimates the q-th quantile, 0 <= q <= 1, by interpolating within its bucket.
+        Values beyond the last bucket are reported as its upper bound.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    Registry of the counters, gauges and histograms of a process.
+
+    Names follow the Prometheus conventions and may carry labels, e.g.
+    'http_responses_total{status="200"}'. Updates are thread-safe.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1.0) -> None:
+        """Adds `value` to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0.0) + value
+
+    def set(self, name: str, value: float) -> None:
+        """Sets a gauge to its current value."""
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        """Records a value in a histogram, usually a duration in seconds."""
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Records the duration of the block in the histogram `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self) -> None:
+        """Forgets everything recorded so far."""
+        with self._lock:
+            self.started = time.time()
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def _sample_process(self) -> None:
+        process = psutil.Process()
+        memory = process.memory_info()
+        self.set("process_resident_memory_bytes", memory.rss)
+        self.set("process_virtual_memory_bytes", memory.vms)
+        cpu = process.cpu_times()
+        self.set("process_cpu_seconds_total", cpu.user + cpu.system)
+
+    def prometheus(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        self._sample_process()
+        lines: list[str] = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name} {value:g}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"{name} {value:g}")
+            for name, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum {histogram.sum:g}")
+                lines.append(f"{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Returns the current state as a flat dict: counters, gauges, and the count, mean
+        and percentiles of every histogram.
+        """
+        self._sample_process()
+        with self._lock:
+            snapshot: dict[str, Any] = {
+                "time": time.time(),
+                "uptime": time.time() - self.started,
+                **self.counters,
+                **self.gauges,
+            }
+            for name, histogram in self.histograms.items():
+                snapshot[f"{name}_count"] = histogram.count
+                if histogram.count:
+                    snapshot[f"{name}_mean"] = histogram.sum / histogram.count
+                for q in PERCENTILES:
+                    snapshot[f"{name}_p{round(q * 100)}"] = histogram.percentile(q)
+        return snapshot
+
+
+METRICS = Metrics()
+"""The registry every stage of the crawl records into."""
+
+
+def timed(func: Callable[..., Any], *args: Any) -> tuple[Any, float]:
+    """
+    Calls `func(*args)` and returns its result with the duration in seconds. Picklable,
+    so worker processes can time their work for the registry of the main process.
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+async def report_periodically(
+    path: Path, interval: float = REPORT_INTERVAL, metrics: Metrics = METRICS
+) -> None:
+    """
+    Appends a snapshot of the metrics to a JSON lines file every `interval` seconds,
+    with the bytes, requests and posts per second over the last interval. Runs until
+    cancelled, writing a last line on the way out.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    previous = metrics.snapshot()
+
+    def write() -> None:
+        nonlocal previous
+        snapshot = metrics.snapshot()
+        elapsed = max(snapshot["time"] - previous["time"], 1e-9)
+        for name in ("fetch_bytes_total", "fetch_requests_total", "posts_parsed_total"):
+            rate = (snapshot.get(name, 0.0) - previous.get(name, 0.0)) / elapsed
+            snapshot[name.removesuffix("_total") + "_per_second"] = rate
+        with open(path, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+        previous = snapshot
+
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            write()
+    finally:
+        write()
+
+
+async def serve_metrics(port: int, metrics: Metrics = METRICS) -> web.AppRunner:
+    """
+    Serves the metrics in the Prometheus text format at http://localhost:{port}/metrics
+    from the running event loop.
+
+    Returns:
+        web.AppRunner: The running server. Stop it with `await runner.cleanup()`.
+    """
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", port).start()
+    print(f"Serving metrics at http://localhost:{port}/metrics")
+    return runner
@@ -0,0 +1,240 @@
+"""
+A local mock of the XenForo forum pages the scraper reads, for benchmarks.
+
+The pages carry exactly the markup the parsers look for. Latency, error rate and the
+size of the forum are configurable, and thread pages answer conditional requests.
+"""
+
+import asyncio
+import multiprocessing
+import random
+import socket
+import time
+from dataclasses import dataclass
+
+from aiohttp import web
+
+THREADS_PER_INDEX_PAGE = 20
+STARTUP_TIMEOUT = 10.0  # seconds
+
+
+@dataclass(slots=True)
+class MockForumConfig:
+    """
+    Attributes:
+        threads (int): The number of threads in the forum.
+        max_pages (int): Threads have 1 to `max_pages` pages.
+        posts_per_page (int): The number of posts on a full thread page.
+        latency (float): The mean delay of every response in seconds.
+        jitter (float): Responses are delayed by up to this many seconds more or less.
+        error_rate (float): The fraction of thread page requests answered with 503.
+        post_length (int): The number of words of every post.
+        seed (int): Makes the generated forum and errors reproducible.
+    """
+
+    threads: int = 200
+    max_pages: int = 5
+    posts_per_page: int = 20
+    latency: float = 0.05
+    jitter: float = 0.02
+    error_rate: float = 0.0
+    post_length: int = 80
+    seed: int = 0
+
+    @property
+    def index_pages(self) -> int:
+        return max(1, -(-self.threads // THREADS_PER_INDEX_PAGE))
+
+    def thread_pages(self, thread_id: int) -> int:
+        return 1 + thread_id % self.max_pages
+
+    @property
+    def total_thread_pages(self) -> int:
+        return sum(self.thread_pages(i) for i in range(1, self.threads + 1))
+
+
+_WORDS = (
+    "the forum post thread reply quote people think because really never always "
+    "women men life time world good bad just like know want would could"
+).split()
+
+
+def thread_page(config: MockForumConfig, thread_id: int, page: int) -> str:
+    """Renders a page of a thread like XenForo does."""
+    rng = random.Random(config.seed * 1_000_003 + thread_id * 1009 + page)
+    articles = []
+    for i in range(config.posts_per_page):
+        post_id = (thread_id * 1000 + page) * 100 + i
+        first = page == 1 and i == 0
+        classes = "message js-post js-inlineModContainer " + (
+            "message--article is-first" if first else "message--post"
+        )
+        words = " ".join(rng.choice(_WORDS) for _ in range(config.post_length))
+        embeds = ""
+        if i % 5 == 1:
+            embeds += "<blockquote class='bbCodeBlock'>an earlier post</blockquote>"
+        if i % 7 == 2:
+            embeds += "<div class='bbImageWrapper'><img src='/i.png'></div>"
+        if i % 11 == 3:
+            embeds += "<span data-s9e-mediaembed='youtube'><iframe></iframe></span>"
+        scripts = ""
+        if i % 13 == 4:
+            # Inline scripts and styles, whose text is not part of the post
+            scripts = "<script>var x = 1;</script> <style>p { margin: 0 }</style>"
+        articles.append(
+            f'<article class="{classes}" data-author="user{rng.randrange(500)}" '
+            f'data-content="post-{post_id}">'
+            f'<header><time class="u-dt" datetime="2023-0{1 + i % 9}-1{i % 10}T10:00:00'
+            '+0000">date</time></header>'
+            f'<div class="message-content"><div class="bbWrapper">{embeds}{words} &amp; '
+            f"<b>more</b>{scripts} {words[:40]}</div></div></article>"
+        )
+    first = articles[0] if page == 1 else ""
+    replies = "".join(articles[1:] if page == 1 else articles)
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Thread</title></head>'
+        f'<body><div class="block-container lbContainer" data-lb-id="thread-{thread_id}">'
+        f'{first}<div class="block-body js-replyNewMessageContainer">{replies}</div>'
+        "</div></body></html>"
+    )
+
+
+def index_page(config: MockForumConfig, page: int) -> str:
+    """Renders a page of the forum index like XenForo does."""
+    items = []
+    first = (page - 1) * THREADS_PER_INDEX_PAGE + 1
+    last = min(first + THREADS_PER_INDEX_PAGE, config.threads + 1)
+    for thread_id in range(first, last):
+        pages = config.thread_pages(thread_id)
+        jump = ""
+        if pages > 1:
+            links = "".join(f'<a href="#">{i}</a>' for i in range(2, pages + 1))
+            jump = f'<span class="structItem-pageJump">{links}</span>'
+        items.append(
+            f'<div class="structItem" data-author="op{thread_id}">'
+            f'<a data-tp-primary="on" href="/threads/thread-title-{thread_id}.{thread_id}/">'
+            f"Thread title {thread_id}</a>{jump}"
+            '<time class="structItem-latestDate u-dt" datetime="2023-06-01T00:00:00+0000">'
+            "date</time></div>"
+        )
+    nav = "".join(
+        f'<li><a href="#">{i}</a></li>' for i in range(1, config.index_pages + 1)
+    )
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"></head><body>'
+        f'<ul class="pageNav-main">{nav}</ul>'
+        f'<div class="js-threadList">{"".join(items)}</div></body></html>'
+    )
+
+
+def create_app(config: MockForumConfig) -> web.Application:
+    """Creates the aiohttp application serving the mock forum."""
+    rng = random.Random(config.seed)
+
+    async def delay() -> None:
+        await asyncio.sleep(
+            max(0.0, config.latency + rng.uniform(-config.jitter, config.jitter))
+        )
+
+    async def forum(request: web.Request) -> web.Response:
+        await delay()
+        page = int(request.match_info.get("page", 1))
+        if page > config.index_pages:
+            raise web.HTTPNotFound()
+        return web.Response(text=index_page(config, page), content_type="text/html")
+
+    async def thread(request: web.Request) -> web.Response:
+        await delay()
+        thread_id = int(request.match_info["id"])
+        page = int(request.match_info.get("page", 1))
+        if not 1 <= thread_id <= config.threads or page > config.thread_pages(thread_id):
+            raise web.HTTPNotFound()
+        if rng.random() < config.error_rate:
+            raise web.HTTPServiceUnavailable()
+        etag = f'"{config.seed}-{thread_id}-{page}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        response = web.Response(
+            text=thread_page(config, thread_id, page),
+            content_type="text/html",
+            headers={"ETag": etag},
+        )
+        response.enable_compression()
+        return response
+
+    app = web.Application()
+    app.router.add_get("/forums/{label}.{forum}", forum)
+    app.router.add_get("/forums/{label}.{forum}/page-{page}", forum)
+    app.router.add_get("/threads/{label}.{id}/", thread)
+    app.router.add_get("/threads/{label}.{id}/page-{page}", thread)
+    return app
+
+
+def _serve(config: MockForumConfig, port: int) -> None:
+    web.run_app(
+        create_app(config), host="127.0.0.1", port=port, print=None, access_log=None
+    )
+
+
+class MockForum:
+    """
+    Serves a mock forum from a separate process, so that serving it takes neither CPU
+    time nor the GIL from the crawl being measured.
+
+    Usage:
+        with MockForum(MockForumConfig(threads=50)) as url:
+            Website(url).load_and_save_forum("benchmark", 1)
+
+    Attributes:
+        config (MockForumConfig): The forum served.
+        port (int): The port served on, a free one if 0.
+    """
+
+    def __init__(self, config: MockForumConfig, port: int = 0) -> None:
+        self.config = config
+        self.port = port
+        self._process: multiprocessing.Process | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def pid(self) -> int | None:
+        """The id of the serving process while it runs."""
+        return self._process.pid if self._process is not None else None
+
+    def __enter__(self) -> str:
+        if not self.port:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                self.port = s.getsockname()[1]
+        self._process = multiprocessing.Process(
+            target=_serve, args=(self.config, self.port), daemon=True
+        )
+        self._process.start()
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return self.url
+            except OSError:
+                if time.monotonic() > deadline or not self._process.is_alive():
+                    self.__exit__()
+                    raise RuntimeError("The mock forum did not start")
+                time.sleep(0.05)
+
+    def __exit__(self, *exc) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+
+if __name__ == "__main__":
+    # Serve a mock forum to point a crawl at: python -m src.scraper.mock_forum 8765
+    import sys
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    print(f"Serving a mock forum at http://127.0.0.1:{port}/forums/benchmark.1")
+    web.run_app(create_app(MockForumConfig()), host="127.0.0.1", port=port, print=None)
@@ -0,0 +1,150 @@
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+@dataclass(slots=True)
+class Thread:
+    """Represents a thread in a forum"""
+
+    url_label: str
+    id: int
+    title: str
+    author: str
+    pages: int
+    """The number of pages in the thread"""
+    scraped: datetime = datetime.now()
+    last_post: datetime | None = None
+    """The time of the latest post, as shown in the forum index"""
+
+
+@dataclass(slots=True)
+class Forum:
+    """Represents a forum on a website"""
+
+    url_label: str
+    id: int
+    title: str
+    pages: int
+    """The number of pages in the forum"""
+
+
+@dataclass(slots=True)
+class Post:
+    """Represents a post in a forum thread"""
+
+    author: str
+    """The author of the post"""
+    id: int
+    """The id of the post"""
+    content: str
+    """The content of the post"""
+    thread_id: int
+    """The id of the thread to which this post belongs"""
+    date_posted: datetime
+    """The date the post was made"""
+
+
+class PostBatch:
+    """
+    Columnar buffer of posts. Keeps one compact array per field instead of one object
+    per post: ids and timestamps as int64 arrays, authors as codes into a list of
+    distinct names. Converts to Arrow or pandas without copying the numeric columns.
+
+    Attributes:
+        content (list[str]): The content of every post.
+        authors (list[str]): The distinct author names, indexed by the author codes.
+            Posts without an author have the code -1.
+    """
+
+    def __init__(self) -> None:
+        self.ids = array("q")
+        self.thread_ids = array("q")
+        self.timestamps = array("q")
+        """Microseconds since the epoch in UTC"""
+        self.author_codes = array("i")
+        self.content: list[str] = []
+        self.authors: list[str] = []
+        self._author_index: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Post]:
+        for i in range(len(self)):
+            yield Post(
+                self.authors[code] if (code := self.author_codes[i]) >= 0 else None,  # type: ignore
+                self.ids[i],
+                self.content[i],
+                self.thread_ids[i],
+                _EPOCH + timedelta(microseconds=self.timestamps[i]),
+            )
+
+    def append_rows(self, rows: Iterable[tuple[str, int, str, int, datetime]]) -> None:
+        """Appends posts given as tuples in the field order of Post."""
+        for author, id, content, thread_id, date_posted in rows:
+            code = self._author_index.get(author, -1)
+            if code < 0 and author is not None:
+                code = self._author_index[author] = len(self.authors)
+                self.authors.append(author)
+            if date_posted.tzinfo is None:
+                date_posted = date_posted.replace(tzinfo=timezone.utc)
+            self.author_codes.append(code)
+            self.ids.append(id)
+            self.content.append(content)
+            self.thread_ids.append(thread_id)
+            self.timestamps.append((date_posted - _EPOCH) // _MICROSECOND)
+
+    def extend(self, posts: Iterable[Post]) -> None:
+        """Appends Post objects."""
+        self.append_rows(
+            (post.author, post.id, post.content, post.thread_id, post.date_posted)
+            for post in posts
+        )
+
+    def to_arrow(self) -> pa.Table:
+        """Returns the posts as an Arrow table, the authors dictionary-encoded."""
+        codes = np.frombuffer(self.author_codes, dtype=np.int32)
+        return pa.table(
+            {
+                "author": pa.DictionaryArray.from_arrays(
+                    pa.array(codes, mask=codes < 0),
+                    pa.array(self.authors, pa.string()),
+                ),
+                "id": np.frombuffer(self.ids, dtype=np.int64),
+                "content": pa.array(self.content, pa.string()),
+                "thread_id": np.frombuffer(self.thread_ids, dtype=np.int64),
+                "date_posted": pa.array(
+                    np.frombuffer(self.timestamps, dtype=np.int64),
+                    pa.timestamp("us", tz="UTC"),
+                ),
+            }
+        )
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Returns the posts as a DataFrame with the columns of Post. The id, thread_id
+        and author code columns are views of the buffers rather than copies.
+        """
+        timestamps = np.frombuffer(self.timestamps, dtype=np.int64).view("M8[us]")
+        return pd.DataFrame(
+            {
+                "author": pd.Categorical.from_codes(
+                    np.frombuffer(self.author_codes, dtype=np.int32),
+                    categories=pd.Index(self.authors, dtype=object),
+                ),
+                "id": np.frombuffer(self.ids, dtype=np.int64),
+                "content": self.content,
+                "thread_id": np.frombuffer(self.thread_ids, dtype=np.int64),
+                "date_posted": pd.DatetimeIndex(timestamps).tz_localize("UTC"),
+            },
+            copy=False,
+        )
@@ -0,0 +1,183 @@
+import asyncio
+import inspect
+import os
+from concurrent.futures import Executor
+from typing import Any, Awaitable, Callable
+
+import aiohttp
+
+from src.scraper.cache import PageCache
+from src.scraper.fetcher import Limiter, fetch_page
+from src.scraper.metrics import METRICS, timed
+from src.utils import ProgressReporter
+
+PARSE_WORKERS = os.cpu_count() or 4
+PARSE_BATCH = 16  # most pages sent to a parser process in one task
+QUEUE_SIZE = 200  # pages held in memory between the fetch and parse stages
+
+_DONE = object()
+"""Sentinel pushed through the queues to shut down the next stage."""
+
+
+async def fetch_cached(
+    session: aiohttp.ClientSession,
+    url: str,
+    limiter: Limiter,
+    cache: PageCache | None,
+    forum: str,
+) -> tuple[bytes, bool]:
+    """
+    Fetches the raw page of a url. With a cache, the request is conditional on the
+    validators of the cached copy and the cached copy is returned if the server answers
+    304; a new or changed page is stored in the cache under `forum`.
+
+    Returns:
+        tuple[bytes, bool]: The page and whether it was modified.
+    """
+    validators = cache.validators(url) if cache is not None else None
+    page = await fetch_page(session, url, limiter, *(validators or (None, None)))
+    if page.body is None:
+        # 304 Not Modified, only asked for when the page is cached
+        return cache.get(url), False  # type: ignore
+    if cache is not None:
+        cache.put(url, page.body, forum, page.etag, page.last_modified)
+    return page.body, True
+
+
+def parse_batch(parse: Callable[[Any], Any], pages: list[Any]) -> list[tuple[Any, float]]:
+    """
+    Runs `parse` on every page. Lets a worker process handle many pages per task.
+
+    Returns:
+        list[tuple[Any, float]]: The result of every page and how long it took.
+    """
+    return [timed(parse, page) for page in pages]
+
+
+async def run_pipeline(
+    session: aiohttp.ClientSession,
+    urls: list[str],
+    parse: Callable[[bytes], Any],
+    write: Callable[[str, Any], Awaitable[None] | None],
+    executor: Executor,
+    limiter: Limiter,
+    parse_workers: int = PARSE_WORKERS,
+    parse_batch_size: int = PARSE_BATCH,
+    queue_size: int = QUEUE_SIZE,
+    cache: PageCache | None = None,
+    forum: str = "",
+) -> list[str]:
+    """
+    Streams urls through three concurrent stages: fetch -> parse -> write.
+
+    Fetchers download pages into a bounded queue as fast as `limiter` admits them,
+    parsers run `parse` on the pages in `executor` and the single writer calls
+    `write(url, result)` in the event loop, awaiting it if it returns an awaitable. Parsers hand the pages already waiting to a
+    worker together, up to `parse_batch_size` per task, so the dispatch overhead shrinks
+    when parsing falls behind. The queues are bounded, so peak memory depends on `queue_size`, not on the number of urls,
+    and fetching keeps going while earlier pages are being parsed.
+
+    Args:
+        session (aiohttp.ClientSession): The session used for fetching.
+        urls (list[str]): The urls to fetch.
+        parse (Callable[[Any], Any]): Picklable function that parses a page.
+        write (Callable[[str, Any], Awaitable[None] | None]): Called with every url and
+            its parse result. Can be a coroutine function, to do blocking work such as
+            writing to disk in a thread.
+        executor (Executor): The executor the parse function is run in.
+        limiter (Limiter): The controller admitting the requests.
+        parse_workers (int): The number of parse tasks running at the same time.
+        parse_batch_size (int): The most pages sent to the executor in one task.
+        queue_size (int): The maximum number of pages waiting in each queue.
+        cache (PageCache | None): Makes the requests conditional on the cached pages
+            and stores new and changed pages under `forum`. See `fetch_cached`.
+        forum (str): The forum the pages belong to, e.g. "the-lounge.4".
+
+    Returns:
+        list[str]: The dead-letter list of urls that could not be fetched even after
+            retrying. The other pages are processed regardless.
+
+    Raises:
+        Exception: Any other exception raised by a stage cancels the pipeline and is
+            re-raised.
+    """
+    failed: list[str] = []
+    if not urls:
+        return failed
+    loop = asyncio.get_running_loop()
+    url_queue: asyncio.Queue[Any] = asyncio.Queue()
+    html_queue: asyncio.Queue[Any] = asyncio.Queue(maxsize=queue_size)
+    result_queue: asyncio.Queue[Any] = asyncio.Queue(maxsize=queue_size)
+    for url in urls:
+        url_queue.put_nowait(url)
+    fetch_workers = min(limiter.max_concurrency, len(urls))
+    for _ in range(fetch_workers):
+        url_queue.put_nowait(_DONE)
+
+    progress = ProgressReporter(len(urls), prefix="Crawling:")
+
+    not_modified = 0
+
+    async def fetcher() -> None:
+        nonlocal not_modified
+        while (url := await url_queue.get()) is not _DONE:
+            try:
+                html, modified = await fetch_cached(session, url, limiter, cache, forum)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"\nGiving up on {url}: {e!r}")
+                failed.append(url)
+                progress.update()
+                continue
+            not_modified += not modified
+            if html_queue.full():
+                # Parsing cannot keep up with the network
+                with METRICS.timer("pipeline_fetch_blocked_seconds"):
+                    await html_queue.put((url, html))
+            else:
+                await html_queue.put((url, html))
+
+    async def parser() -> None:
+        finished = False
+        while not finished:
+            METRICS.set("pipeline_html_queue_depth", html_queue.qsize())
+            if (item := await html_queue.get()) is _DONE:
+                break
+            batch = [item]
+            while len(batch) < parse_batch_size and not html_queue.empty():
+                if (item := html_queue.get_nowait()) is _DONE:
+                    finished = True
+                    break
+                batch.append(item)
+            results = await loop.run_in_executor(
+                executor, parse_batch, parse, [html for _, html in batch]
+            )
+            for (url, _), (result, seconds) in zip(batch, results):
+                METRICS.observe("parse_page_seconds", seconds)
+                await result_queue.put((url, result))
+            METRICS.inc("pages_parsed_total", len(batch))
+
+    async def writer() -> None:
+        while True:
+            METRICS.set("pipeline_result_queue_depth", result_queue.qsize())
+            if (item := await result_queue.get()) is _DONE:
+                break
+            with METRICS.timer("write_page_seconds"):
+                if inspect.isawaitable(result := write(*item)):
+                    await result
+            progress.update()
+
+    async def close(tasks: list[asyncio.Task[None]], queue: asyncio.Queue[Any], n: int):
+        # Wait for a stage to drain and tell the next stage that no more items follow
+        await asyncio.gather(*tasks)
+        for _ in range(n):
+            await queue.put(_DONE)
+
+    async with asyncio.TaskGroup() as group:
+        fetchers = [group.create_task(fetcher()) for _ in range(fetch_workers)]
+        parsers = [group.create_task(parser()) for _ in range(parse_workers)]
+        group.create_task(writer())
+        group.create_task(close(fetchers, html_queue, parse_workers))
+        group.create_task(close(parsers, result_queue, 1))
+    if cache is not None:
+        print(f"\n{not_modified} of {len(urls)} pages not modified since cached")
+    return failed
@@ -0,0 +1,78 @@
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.scraper.metrics import METRICS
+from src.scraper.models import Post, PostBatch
+
+POST_SCHEMA = pa.schema(
+    [
+        ("author", pa.string()),
+        ("id", pa.int64()),
+        ("content", pa.string()),
+        ("thread_id", pa.int64()),
+        ("date_posted", pa.timestamp("us", tz="UTC")),
+    ]
+)
+"""The columns of a post in the Parquet files, in the field order of Post."""
+
+
+class ParquetSink:
+    """
+    Append-only store of posts: every write adds one Parquet file to a directory, so the
+    cost of a write depends only on the posts written, not on what is already stored.
+    All files together are read back as one dataset.
+
+    Attributes:
+        directory (Path): The directory holding the Parquet files.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._parts = len(self.part_paths())
+
+    def part_paths(self) -> list[Path]:
+        """Returns the Parquet files in the order they were written."""
+        return sorted(self.directory.glob("part-*.parquet"))
+
+    def write(self, posts: PostBatch | list[Post]) -> None:
+        """
+        Writes the posts to a new Parquet file. The file is renamed into place once
+        complete, so a crash never leaves a partial file in the dataset.
+        """
+        if not len(posts):
+            return
+        if not isinstance(posts, PostBatch):
+            batch = PostBatch()
+            batch.extend(posts)
+            posts = batch
+        with METRICS.timer("sink_write_seconds"):
+            table = posts.to_arrow().cast(POST_SCHEMA)
+            path = self.directory / f"part-{self._parts:06d}.parquet"
+            tmp = path.with_suffix(".tmp")
+            pq.write_table(table, tmp)
+            tmp.rename(path)
+        self._parts += 1
+        METRICS.inc("sink_rows_total", len(table))
+        METRICS.inc("sink_bytes_total", path.stat().st_size)
+
+    def dataset(self) -> ds.Dataset:
+        """Returns a dataset over all files written so far, without loading them."""
+        return ds.dataset(
+            [str(path) for path in self.part_paths()], schema=POST_SCHEMA, format="parquet"
+        )
+
+    def read(self) -> pd.DataFrame:
+        """Loads all posts in the order they were written."""
+        return self.dataset().to_table().to_pandas()
+
+    def clear(self) -> None:
+        """Deletes every file of the sink."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._parts = 0
@@ -1,4 +1,8 @@
+import json
+import time
+from dataclasses import asdict
 from pathlib import Path
+from typing import Any
 
 import pandas as pd
 
@@ -35,6 +39,57 @@ def print_progress_bar(
         print()
 
 
+class ProgressReporter:
+    """
+    Reports the progress of a long-running stage as a terminal progress bar, redrawn at
+    most every `interval` seconds so that fast loops do not spend their time printing.
+
+    Attributes:
+        total (int): The number of items the stage processes.
+        done (int): The number of items processed so far.
+        prefix (str): The label shown before the bar.
+    """
+
+    def __init__(self, total: int, prefix: str = "", interval: float = 0.5) -> None:
+        self.total = total
+        self.done = 0
+        self.prefix = prefix
+        self.interval = interval
+        self._started = time.monotonic()
+        self._drawn = 0.0
+
+    def update(self, n: int = 1) -> None:
+        """Advances the progress by `n` items."""
+        self.done += n
+        now = time.monotonic()
+        if self.total and (now - self._drawn >= self.interval or self.done >= self.total):
+            self._drawn = now
+            elapsed = now - self._started
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            print_progress_bar(
+                min(self.done, self.total),
+                self.total,
+                prefix=self.prefix,
+                suffix=f"{rate:.1f}/s",
+                decimals=2,
+            )
+
+
+def save_results(results: list[Any], path: Path) -> None:
+    """
+    Appends benchmark results to a JSON lines file, to compare them across changes.
+
+    Args:
+        results (list[Any]): The results, dataclasses with a `per_second` property.
+        path (Path): The JSON lines file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        for result in results:
+            record = {"time": time.time(), **asdict(result), "per_second": result.per_second}
+            f.write(json.dumps(record) + "\n")
+
+
 def load_data_from_csv(
     posts_paths: list[Path], threads_paths: list[Path]
 ) -> tuple[pd.DataFrame, pd.DataFrame]:
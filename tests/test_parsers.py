@@ -0,0 +1,67 @@
+import pytest
+
+from src.scraper.mock_forum import MockForumConfig, thread_page
+from src.scraper.models import Post
+from src.scraper.parsers import POST_PARSERS, check_parity, extract_posts_bs4
+
+BACKENDS = [name for name in POST_PARSERS if name != "bs4"]
+
+
+def page(*bodies: str) -> str:
+    """A thread page with one post per body, the inner html of its bbWrapper."""
+    articles = "".join(
+        f'<article class="message js-post js-inlineModContainer message--post" '
+        f'data-author="user{i}" data-content="post-{i + 1}"><header>'
+        '<time class="u-dt" datetime="2023-01-10T10:00:00+0000">date</time></header>'
+        f'<div class="message-content"><div class="bbWrapper">{body}</div></div>'
+        "</article>"
+        for i, body in enumerate(bodies)
+    )
+    return (
+        '<!DOCTYPE html><html><body><div class="block-container lbContainer" '
+        'data-lb-id="thread-7"><div class="block-body js-replyNewMessageContainer">'
+        f"{articles}</div></div></body></html>"
+    )
+
+
+EDGE_CASES = {
+    "script and style": page(
+        "before <script>var x = 1;</script><style>p { margin: 0 }</style> after"
+    ),
+    "nested quotes": page(
+        "<blockquote class='bbCodeBlock'>outer <blockquote class='bbCodeBlock'>"
+        "inner</blockquote> still quoted</blockquote> the reply"
+    ),
+    "empty post": page("", "not empty"),
+}
+
+
+@pytest.mark.parametrize("parser", BACKENDS)
+def test_mock_forum_pages(parser: str) -> None:
+    config = MockForumConfig(threads=20)
+    pages = [
+        thread_page(config, thread_id, number)
+        for thread_id in range(1, config.threads + 1)
+        for number in range(1, config.thread_pages(thread_id) + 1)
+    ]
+    assert check_parity(pages, parser) == config.posts_per_page * len(pages)
+
+
+@pytest.mark.parametrize("parser", BACKENDS)
+@pytest.mark.parametrize("case", EDGE_CASES)
+def test_edge_cases(parser: str, case: str) -> None:
+    html = EDGE_CASES[case]
+    assert check_parity([html, html.encode()], parser) == 2 * len(
+        extract_posts_bs4(html)
+    )
+
+
+def test_difference_is_reported(monkeypatch: pytest.MonkeyPatch) -> None:
+    def shouting(html: str | bytes) -> list[Post]:
+        posts = extract_posts_bs4(html)
+        posts[1].content = posts[1].content.upper()
+        return posts
+
+    monkeypatch.setitem(POST_PARSERS, "shouting", shouting)
+    with pytest.raises(ValueError, match="page 0, post 1 in content"):
+        check_parity([page("one", "two")], "shouting")